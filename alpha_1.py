@@ -1,80 +1,68 @@
-from flask import Flask, Response
+from flask import Flask, request
 import threading
 import time
 import cv2
+from pithermcam_fixed_temps import pithermalcam
+from frame_ring import FrameSlot, newest_frames
+from therm_blend import FusionBlender
+from stream_hub import VariantHubs
+from stream_server import run
 
 app = Flask(__name__)
 
-# Global variables to hold the video frames and locks
-hd_output_frame = None
-thermal_output_frame = None
-hd_lock = threading.Lock()
-thermal_lock = threading.Lock()
+# Global slots holding the newest video frames
+frames_ready = threading.Condition()  # A new frame from either camera wakes the blend renderers
+hd_frames = FrameSlot(frames_ready)
+thermal_frames = FrameSlot(frames_ready)
 
 # Function to capture frames from HD camera
 def capture_hd_camera():
-    global hd_output_frame, hd_lock
     cap = cv2.VideoCapture(0)  # Change the camera index if necessary
     while True:
         ret, frame = cap.read()
         if not ret:
             continue
-        with hd_lock:
-            hd_output_frame = frame.copy()
+        hd_frames.publish(frame)
 
 # Function to capture frames from thermal camera
 def capture_thermal_camera():
-    global thermal_output_frame, thermal_lock
-    cam = pithermalcam(use_f=False, filter_image=True)
+    cam = pithermalcam(use_f=False, filter_image=True, fixed_range=None, adaptive_refresh=True)
     while True:
-        cam.update()
-        with thermal_lock:
-            thermal_output_frame = cam._image.copy()
+        cam.set_client_count(stream_variants.clients)  # Lets the refresh rate drop while no blend is being streamed
+        # Premultiplied BGRA, transparent below 30 C and opaque above 40 C per pixel; never modified once returned
+        frame = cam.update_bgra_frame(size=(640, 480))
+        thermal_frames.publish(frame)
 
-# Function to generate combined video stream
-def generate():
-    global hd_output_frame, thermal_output_frame, hd_lock, thermal_lock
-    alpha = 0.5  # Transparency factor
+# Function returning the renderer of one stream variant, blending at size (width, height)
+def frame_renderer(size:tuple = (640, 480), layout:str = 'blend'):
+    blender = FusionBlender(size, 'premultiplied')  # The thermal frame carries its own per-pixel alpha
+    seen = (0, 0)  # Sequence numbers of the HD and thermal frames last rendered
 
-    while True:
-        with hd_lock:
-            hd_frame = hd_output_frame.copy() if hd_output_frame is not None else None
-        with thermal_lock:
-            thermal_frame = thermal_output_frame.copy() if thermal_output_frame is not None else None
-        
-        if hd_frame is None or thermal_frame is None:
-            continue
+    # Function to render the combined frame, or None if neither camera has a new frame within a second
+    def render_frame():
+        nonlocal seen
+        seen, frames = newest_frames((hd_frames, thermal_frames), seen, timeout=1.0)
+        if frames is None:
+            return None
+        hd_frame, thermal_frame = frames
 
-        # Resize thermal frame to match the HD frame size
-        hd_frame = cv2.resize(hd_frame, (640, 480))
-        thermal_frame = cv2.resize(thermal_frame, (640, 480))
-        
-        # Check if thermal frame has an alpha channel
-        if thermal_frame.shape[2] == 4:
-            # Split alpha channel from thermal frame
-            b, g, r, a = cv2.split(thermal_frame)
-            overlay = cv2.merge((b, g, r))
-            mask = a / 255.0
-            inverse_mask = 1.0 - mask
+        # Resize the HD frame straight into the blender; premultiplied BGRA can be resized like any image
+        cv2.resize(hd_frame, size, dst=blender.base)
+        if thermal_frame.shape[1::-1] != size:
+            thermal_frame = cv2.resize(thermal_frame, size)
 
-            # Blend the frames using the alpha mask
-            for c in range(0, 3):
-                hd_frame[:, :, c] = (inverse_mask * hd_frame[:, :, c] + mask * overlay[:, :, c])
-        else:
-            # Blend the thermal frame with the HD frame if no alpha channel
-            blended_frame = cv2.addWeighted(hd_frame, 1 - alpha, thermal_frame, alpha, 0)
+        # Composite in one integer multiply-add using the thermal frame's alpha
+        return blender.blend(bgra=thermal_frame)
+    return render_frame
 
-        # Encode combined frame
-        (flag, encoded_image) = cv2.imencode(".jpg", hd_frame)
-        if not flag:
-            continue
-        
-        yield (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + bytearray(encoded_image) + b'\r\n')
+# Variants for ?w=&h=&q=; the default matches the 640x480 thermal frame
+stream_variants = VariantHubs(frame_renderer, (640, 480), layouts=('blend',))
 
 # Route to handle the video feed
 @app.route('/video_feed')
 def video_feed():
-    return Response(generate(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    # ?w=&h=&q= resize the blend or change its JPEG quality; bad values get a 400
+    return stream_variants.response(request.args)
 
 # Main function to start the threads and Flask app
 if __name__ == '__main__':
@@ -88,5 +76,5 @@ if __name__ == '__main__':
     thermal_thread.daemon = True
     thermal_thread.start()
 
-    # Start Flask app
-    app.run(host='0.0.0.0', port=5000, debug=True, threaded=True, use_reloader=False)
+    # Start Flask app, or the asyncio server with --async; there is no page, only the blended feed
+    run(app, {'/video_feed': stream_variants}, port=5000, page=None)
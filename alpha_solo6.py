@@ -1,4 +1,4 @@
-from flask import Flask, Response, render_template
+from flask import Flask, render_template, request
 import threading
 import time
 import cv2
@@ -9,15 +9,18 @@ import adafruit_mlx90640
 import busio
 import board
 
-from pi_therm_cam import pithermalcam
+from pithermcam_fixed_temps import pithermalcam
+from therm_blend import HotRegions, FusionBlender
+from frame_ring import FrameSlot, newest_frames
+from stream_hub import VariantHubs
+from stream_server import run
 
 app = Flask(__name__)
 
 # Global variables for HD and Thermal camera frames
-hd_output_frame = None
-thermal_output_frame = None
-hd_lock = threading.Lock()
-thermal_lock = threading.Lock()
+frames_ready = threading.Condition()  # Both slots notify it, so the blend is redone when the crop or the thermal frame changes
+hd_frames = FrameSlot(frames_ready)
+thermal_frames = FrameSlot(frames_ready)  # (image, (sequence, 24x32 temperatures in C))
 
 # Define the desired crop dimensions for HD camera
 CROP_TOP = 198
@@ -27,7 +30,6 @@ CROP_RIGHT = 294
 
 # HD Camera Thread and Functionality
 def capture_hd_frames():
-    global hd_output_frame, hd_lock
     picam2_hd = Picamera2()
     config_hd = picam2_hd.create_preview_configuration(main={"size": (1270, 950)})  # Set capture size to 1270x950
     picam2_hd.configure(config_hd)
@@ -42,21 +44,20 @@ def capture_hd_frames():
         # Convert to RGB for compatibility with OpenCV
         cropped_hd_image = cv2.cvtColor(cropped_hd_image, cv2.COLOR_BGR2RGB)
         
-        with hd_lock:
-            hd_output_frame = cropped_hd_image.copy()
+        hd_frames.publish(cropped_hd_image)
         time.sleep(0.03)  # Reduce CPU usage
 
 # Thermal Camera Thread and Functionality
 def pull_images():
-    global thermal_output_frame, thermal_lock
-    thermcam = pithermalcam(output_folder='/home/pi/pithermalcam/saved_snapshots/')
+    thermcam = pithermalcam(output_folder='/home/pi/pithermalcam/saved_snapshots/', fixed_range=None, adaptive_refresh=True)
     time.sleep(0.1)
 
     while True:
-        current_frame = thermcam.update_image_frame()
+        thermcam.set_client_count(stream_variants.clients)
+        current_frame = thermcam.update_image_frame(size=(640, 480))  # Rendered at the blend size
         if current_frame is not None:
-            with thermal_lock:
-                thermal_output_frame = current_frame.copy()
+            temps = thermcam.get_temperature_frame()
+            thermal_frames.publish((current_frame, temps))
         time.sleep(0.03)  # Reduce CPU usage
 
 # Flask Routes
@@ -64,53 +65,40 @@ def pull_images():
 def index():
     return render_template("index.html")
 
-def generate():
-    global hd_output_frame, thermal_output_frame, hd_lock, thermal_lock
-    alpha = 0.5  # Transparency factor for blending
+alpha = 0.5  # Transparency factor for blending
+threshold_temp = 40  # Temperature threshold in °C
 
-    # Define temperature range for the thermal camera
-    min_temp = 5  # Minimum temperature in °C
-    max_temp = 80  # Maximum temperature in °C
-    threshold_temp = 40  # Temperature threshold in °C
+def frame_renderer(size:tuple = (640, 480), layout:str = 'blend'):
+    """Return a render_frame for one stream variant, blending at size (width, height)"""
+    # Regions above threshold_temp, from the sensor temperatures rather than the colormap
+    hot_regions = HotRegions(size, threshold_temp)
+    blender = FusionBlender(size, 'regions', alpha)  # Reuses its buffers every frame
+    seen = (0, 0)  # Sequence numbers of the HD and thermal frames last rendered
 
-    # Calculate pixel value threshold
-    threshold_pixel_value = int((threshold_temp - min_temp) * 255 / (max_temp - min_temp))
+    def render_frame():
+        """Blend the newest frames, or return None if neither camera has a new frame within a second"""
+        nonlocal seen
+        seen, frames = newest_frames((hd_frames, thermal_frames), seen, timeout=1.0)
+        if frames is None:
+            return None
+        hd_frame, (thermal_frame, temps) = frames
 
-    while True:
-        with hd_lock:
-            hd_frame = hd_output_frame.copy() if hd_output_frame is not None else None
-        with thermal_lock:
-            thermal_frame = thermal_output_frame.copy() if thermal_output_frame is not None else None
-        
-        if hd_frame is None or thermal_frame is None:
-            continue
-
-        # Resize frames to match each other
-        hd_frame = cv2.resize(hd_frame, (640, 480))
-        thermal_frame = cv2.resize(thermal_frame, (640, 480))
+        # Resize straight into the blender instead of copying; the thermal frame is rendered at 640x480
+        cv2.resize(hd_frame, size, dst=blender.base)
+        cv2.resize(thermal_frame, size, dst=blender.overlay)
 
-        # Convert thermal frame to grayscale to process temperature values
-        thermal_gray = cv2.cvtColor(thermal_frame, cv2.COLOR_BGR2GRAY)
+        # Blend the thermal frame over the hot areas only; cold pixels aren't touched
+        hot_regions.update(temps[1], temps[0])
+        return blender.blend(regions=hot_regions)
+    return render_frame
 
-        # Create a mask for areas with high temperatures
-        high_temp_mask = thermal_gray >= threshold_pixel_value
-
-        # Blend frames using OpenCV's addWeighted function
-        blended_frame = hd_frame.copy()
-        blended_frame[high_temp_mask] = cv2.addWeighted(
-            hd_frame[high_temp_mask], 1 - alpha, thermal_frame[high_temp_mask], alpha, 0
-        )
-
-        # Encode the blended frame
-        (flag, encoded_image) = cv2.imencode(".jpg", blended_frame)
-        if not flag:
-            continue
-        
-        yield (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + bytearray(encoded_image) + b'\r\n')
+# Blend variants, created on first request; the default is the size the thermal frame is rendered at
+stream_variants = VariantHubs(frame_renderer, (640, 480), layouts=('blend',))
 
 @app.route("/video_feed")
 def video_feed():
-    return Response(generate(), mimetype="multipart/x-mixed-replace; boundary=frame")
+    # Each ?w=&h=&q= blend is rendered once and shared by every client asking for it
+    return stream_variants.response(request.args)
 
 if __name__ == '__main__':
     # Start HD camera thread
@@ -123,5 +111,5 @@ if __name__ == '__main__':
     thermal_thread.daemon = True
     thermal_thread.start()
 
-    # Run Flask app
-    app.run(host='0.0.0.0', port=8010, debug=True, threaded=True, use_reloader=False)
+    # Run Flask app; --async serves index.html and the blended feed from the asyncio server instead
+    run(app, {'/video_feed': stream_variants}, port=8010)
@@ -1,25 +1,23 @@
-from flask import Flask, Response, render_template
+from flask import Flask, render_template, request
 import threading
 import time
 import io
 import cv2
 from picamera2 import Picamera2
-try:  # If called as an imported module
-    from pithermalcam import pithermalcam
-except:  # If run directly
-    from pi_therm_cam import pithermalcam
+from pithermcam_fixed_temps import pithermalcam
+from frame_ring import FrameSlot, newest_frames
+from stream_hub import VariantHubs
+from stream_server import run
 
 app = Flask(__name__)
 
 # Global variables for HD and Thermal camera frames
-hd_output_frame = None
-thermal_output_frame = None
-hd_lock = threading.Lock()
-thermal_lock = threading.Lock()
+frames_ready = threading.Condition()  # The side by side renderer wakes for whichever of the crop or thermal frame arrives first
+hd_frames = FrameSlot(frames_ready)
+thermal_frames = FrameSlot(frames_ready)
 
 # HD Camera Thread and Functionality
 def capture_hd_frames():
-    global hd_output_frame, hd_lock
     picam2_hd = Picamera2()
     config_hd = picam2_hd.create_preview_configuration(main={"size": (2028, 1520)})
     picam2_hd.configure(config_hd)
@@ -40,56 +38,59 @@ def capture_hd_frames():
         # Crop the resized image
         cropped_hd_image = resized_hd_image[crop_top:crop_bottom, crop_left:crop_right]
 
-        with hd_lock:
-            hd_output_frame = cropped_hd_image.copy()
+        hd_frames.publish(cropped_hd_image)
 
 # Thermal Camera Thread and Functionality
 def pull_images():
-    global thermal_output_frame, thermal_lock
-    thermcam = pithermalcam(output_folder='/home/pi/pithermalcam/saved_snapshots/')
+    thermcam = pithermalcam(output_folder='/home/pi/pithermalcam/saved_snapshots/', fixed_range=None,  # Auto-ranged colours like the upstream class
+                            adaptive_refresh=True)
     time.sleep(0.1)
 
     while True:
-        current_frame = thermcam.update_image_frame()
+        thermcam.set_client_count(stream_variants.clients)  # Drops to the lowest refresh rate with no viewers
+        current_frame = thermcam.update_image_frame(size=(320, 240))  # Rendered straight at the 240 pixel display height
         if current_frame is not None:
-            # Resize thermal image to 800x600
-            resized_thermal_frame = cv2.resize(current_frame, (800, 600))
-            with thermal_lock:
-                thermal_output_frame = resized_thermal_frame.copy()
+            thermal_frames.publish(current_frame)
 
 # Flask Routes
 @app.route("/")
 def index():
     return render_template("index.html")
 
-def generate():
-    global hd_output_frame, thermal_output_frame, hd_lock, thermal_lock
-    while True:
-        with hd_lock:
-            hd_frame = hd_output_frame.copy() if hd_output_frame is not None else None
-        with thermal_lock:
-            thermal_frame = thermal_output_frame.copy() if thermal_output_frame is not None else None
-        
-        if hd_frame is None or thermal_frame is None:
-            continue
+def frame_renderer(size:tuple = (640, 240), layout:str = 'sbs'):
+    """Return a render_frame for one stream variant, drawing layout at size (width, height)"""
+    seen = (0, 0)  # Sequence numbers of the HD and thermal frames last rendered
+
+    def render_frame():
+        """Render the newest frames, or return None if neither camera has a new frame within a second"""
+        nonlocal seen
+        sequences, frames = newest_frames((hd_frames, thermal_frames), seen, timeout=1.0)
+        stale = layout == 'hd' and sequences[0] == seen[0] or layout == 'thermal' and sequences[1] == seen[1]
+        seen = sequences
+        if stale or frames is None:  # Stale when only the other camera has a new frame
+            return None
+        hd_frame, thermal_frame = frames
+        if layout == 'hd':
+            return cv2.resize(hd_frame, size)
+        if layout == 'thermal':
+            return cv2.resize(thermal_frame, size)
         
-        # Resize frames to 240 pixels in height
-        hd_frame_resized = cv2.resize(hd_frame, (int(hd_frame.shape[1] * 240 / hd_frame.shape[0]), 240))
-        thermal_frame_resized = cv2.resize(thermal_frame, (int(thermal_frame.shape[1] * 240 / thermal_frame.shape[0]), 240))
+        # Resize the HD frame to the output height keeping its aspect ratio; the thermal frame takes the rest of the width
+        hd_width = min(int(hd_frame.shape[1] * size[1] / hd_frame.shape[0]), size[0] - 1)
+        hd_frame_resized = cv2.resize(hd_frame, (hd_width, size[1]))
+        thermal_frame_resized = cv2.resize(thermal_frame, (size[0] - hd_width, size[1]))
         
         # Combine frames horizontally
-        combined_frame = cv2.hconcat([hd_frame_resized, thermal_frame_resized])
+        return cv2.hconcat([hd_frame_resized, thermal_frame_resized])
+    return render_frame
 
-        # Encode combined frame
-        (flag, encoded_image) = cv2.imencode(".jpg", combined_frame)
-        if not flag:
-            continue
-        
-        yield (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + bytearray(encoded_image) + b'\r\n')
+# Variants for ?w=&h=&q=&layout=; the default is 240 pixels high, the 4:3 HD crop next to the 320x240 thermal frame
+stream_variants = VariantHubs(frame_renderer, (640, 240), layouts=('sbs', 'hd', 'thermal'))
 
 @app.route("/video_feed")
 def video_feed():
-    return Response(generate(), mimetype="multipart/x-mixed-replace; boundary=frame")
+    # e.g. ?layout=hd&h=480 for the HD crop alone; each variant is encoded once for all of its clients
+    return stream_variants.response(request.args)
 
 if __name__ == '__main__':
     # Start HD camera thread
@@ -102,5 +103,5 @@ if __name__ == '__main__':
     thermal_thread.daemon = True
     thermal_thread.start()
 
-    # Run Flask app
-    app.run(host='0.0.0.0', port=8010, debug=True, threaded=True, use_reloader=False)
+    # Run Flask app, or pass --async to serve the cropped side by side feed with per-client ?fps= caps
+    run(app, {'/video_feed': stream_variants}, port=8010)
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/python3
+##################################
+# Simulated MLX90640 on a fake I2C bus, for measuring drivers without hardware
+##################################
+import time
+import random
+import struct
+
+
+class FakeMLX90640Bus:
+    """
+    Stands in for busio.I2C with a simulated MLX90640 at address 0x33.
+
+    The EEPROM holds plausible calibration data for a seeded random sensor. Subpages alternate and
+    become ready at the refresh rate set in the control register. Every transaction is counted in
+    transactions, bytes_read and bytes_written so different frame readers can be compared.
+
+    fault_rate, if given, maps the bus frequency to the probability that a transaction fails with
+    OSError, to simulate a bus that becomes unreliable when clocked too fast.
+    """
+
+    def __init__(self, seed:int = 0, frequency:int = 400000, fault_rate=None):
+        self.frequency = frequency
+        self.fault_rate = fault_rate
+        self._random = random.Random(seed)
+        self._fault_random = random.Random(seed + 1)
+        self._memory = {}
+        self._sub_page = 0
+        self._ready_at = time.monotonic()
+        self._write_eeprom()
+        self._memory[0x8000] = 0x0000  # Status register
+        self._memory[0x800D] = 0x1901  # Control register, chess mode at 2 Hz
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.transactions = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.faults = 0
+
+    def _transaction(self):
+        """Count a transaction and fail it with the frequency dependent fault probability"""
+        self.transactions += 1
+        if self.fault_rate is not None and self._fault_random.random() < self.fault_rate(self.frequency):
+            self.faults += 1
+            raise OSError(121, 'Remote I/O error')
+
+    def _write_eeprom(self):
+        r = self._random
+        eeprom = [0] * 832
+        eeprom[10] = 0x0800  # Chess calibration mode
+        eeprom[16] = 0x4210  # Offset scales
+        eeprom[17] = 0xFFC4  # Offset reference, -60
+        eeprom[32] = 0x4210  # Alpha scales
+        eeprom[33] = 0x2F00 + r.randrange(0x100)  # Alpha reference
+        eeprom[48] = 0x1900  # Gain
+        eeprom[49] = 0x6760  # vPTAT25
+        eeprom[50] = 0x5952  # KvPTAT, KtPTAT
+        eeprom[51] = 0x9D68  # kVdd, vdd25
+        eeprom[52] = 0x2222  # Kv
+        eeprom[53] = 0x2860  # Interleave/chess corrections
+        eeprom[54] = 0x3030  # Kta rows/columns
+        eeprom[55] = 0x3030
+        eeprom[56] = 0x2363  # Resolution, Kv and Kta scales
+        eeprom[57] = 0xE8C0  # CP alpha
+        eeprom[58] = 0xFFC4  # CP offset
+        eeprom[59] = 0x2A2A  # CP Kv, Kta
+        eeprom[60] = 0xF020  # KsTa, Tgc
+        eeprom[61] = 0x9D9D  # KsTo
+        eeprom[62] = 0x9D9D
+        eeprom[63] = 0x2942  # Temperature ranges and KsTo scale
+        eeprom[7:10] = [r.randrange(0x10000) for _ in range(3)]  # Device ID
+        for pixel in range(768):  # Small per-pixel offset, alpha and kta deviations, no bad pixels
+            eeprom[64 + pixel] = (r.randrange(4) << 10) | (r.randrange(1, 5) << 4) | (r.randrange(2) << 1)
+        for i, word in enumerate(eeprom):
+            self._memory[0x2400 + i] = word
+
+    def _write_subpage(self):
+        """Fill RAM with the next subpage: a warm blob on a background near the offset reference"""
+        r = self._random
+        for pixel in range(768):
+            row, col = divmod(pixel, 32)
+            signal = -1000 if (row - 12) ** 2 + (col - 16) ** 2 < 25 else 0
+            self._memory[0x0400 + pixel] = (0xFFC4 + signal + r.randrange(-3, 4)) & 0xFFFF
+        self._memory[0x0400 + 768] = 0x0600  # PTAT art
+        self._memory[0x0400 + 776] = 0xFFC4  # Compensation pixels
+        self._memory[0x0400 + 808] = 0xFFC4
+        self._memory[0x0400 + 778] = 0x1900  # Gain
+        self._memory[0x0400 + 800] = 0x06A0  # PTAT
+        self._memory[0x0400 + 810] = 0xCCC5  # Vdd
+        self._memory[0x8000] = 0x0008 | self._sub_page
+        self._sub_page ^= 1
+
+    def _subpage_period(self):
+        return 1 / (0.5 * 2 ** ((self._memory[0x800D] >> 7) & 0x07))
+
+    def _update_status(self):
+        """Make the next subpage ready once its refresh period has passed"""
+        now = time.monotonic()
+        if not self._memory[0x8000] & 0x0008 and now >= self._ready_at:
+            self._write_subpage()
+            self._ready_at = max(self._ready_at + self._subpage_period(), now)
+
+    # busio.I2C interface used by adafruit_bus_device
+    def try_lock(self):
+        return True
+
+    def unlock(self):
+        pass
+
+    def deinit(self):
+        pass
+
+    def writeto(self, address, buffer, *, start=0, end=None):
+        data = bytes(buffer[start:end])
+        self._transaction()
+        self.bytes_written += len(data)
+        if len(data) >= 4:
+            register = (data[0] << 8) | data[1]
+            word = (data[2] << 8) | data[3]
+            if register == 0x8000:  # Clear the data ready flag
+                self._memory[0x8000] &= ~0x0008
+            else:
+                self._memory[register] = word
+
+    def readfrom_into(self, address, buffer, *, start=0, end=None):
+        self._transaction()
+
+    def writeto_then_readfrom(self, address, buffer_out, buffer_in, *, out_start=0, out_end=None,
+                              in_start=0, in_end=None):
+        out = bytes(buffer_out[out_start:out_end])
+        register = (out[0] << 8) | out[1]
+        in_end = len(buffer_in) if in_end is None else in_end
+        words = (in_end - in_start) // 2
+        self._transaction()
+        self.bytes_written += len(out)
+        self.bytes_read += words * 2
+        if register <= 0x8000 < register + words:
+            self._update_status()
+        for i in range(words):
+            struct.pack_into('>H', buffer_in, in_start + 2 * i, self._memory.get(register + i, 0))
+
+
+if __name__ == "__main__":
+    # Compare I2C transactions per frame between the adafruit driver and MLX90640Fast
+    import numpy as np
+    import adafruit_mlx90640
+    from mlx90640_fast import MLX90640Fast
+
+    frames = 8
+    for name, driver in [('adafruit_mlx90640', adafruit_mlx90640.MLX90640), ('MLX90640Fast', MLX90640Fast)]:
+        bus = FakeMLX90640Bus()
+        mlx = driver(bus)
+        mlx.refresh_rate = adafruit_mlx90640.RefreshRate.REFRESH_16_HZ
+        frame = np.zeros((24*32,))
+        mlx.getFrame(frame)  # Sync to the sensor before counting
+        bus.reset_counters()
+        for _ in range(frames):
+            mlx.getFrame(frame)
+        print(f'{name}: {bus.transactions/frames:.1f} transactions, {(bus.bytes_read+bus.bytes_written)/frames:.0f} bytes per frame, '
+              f'mean {np.mean(frame):.1f}C')
+
+    # Tune a bus that starts failing above 600 kHz
+    from sensor_tuning import I2CFrequencyTuner
+    bus = FakeMLX90640Bus(fault_rate=lambda frequency: 0.0 if frequency <= 600000 else 0.2)
+    mlx = MLX90640Fast(bus)
+    tuner = I2CFrequencyTuner(lambda frequency: setattr(bus, 'frequency', frequency) or bus.frequency)
+    print(f'Tuned I2C frequency: {tuner.tune(mlx.probe_bus)} Hz')
+
+    # The bus degrades at runtime, e.g. as the wiring warms up: reading frames should step the frequency down
+    bus.fault_rate = lambda frequency: 0.0 if frequency <= 400000 else 0.05
+    mlx.refresh_rate = adafruit_mlx90640.RefreshRate.REFRESH_64_HZ
+    frame = np.zeros((24, 32), dtype=np.float32)
+    for _ in range(400):
+        try:
+            mlx.get_subpage_frame(frame)
+            tuner.record()
+        except (OSError, RuntimeError) as e:
+            tuner.record_error(e)
+    print(f'I2C frequency after the bus degraded: {tuner.frequency} Hz, {bus.faults} faults')
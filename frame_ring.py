@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/python3
+##################################
+# Frame hand-off between capture threads and their readers: a preallocated ring and a newest-frame slot
+##################################
+import time
+import threading
+import numpy as np
+
+
+class FrameRing:
+    """
+    A small ring of preallocated frames tagged with sequence numbers and capture timestamps.
+
+    A single writer fills the slot after the newest frame and commits it; readers get a view of the
+    newest committed frame without copying or blocking. With size slots a reader's view stays valid
+    until size-1 newer frames have been committed; readers that keep a frame longer pass their own
+    buffer to latest() to get a copy.
+    """
+
+    def __init__(self, size:int = 4, shape:tuple = (24, 32), dtype=np.float32):
+        self.size = size
+        self._frames = np.full((size,) + tuple(shape), np.nan, dtype=dtype)  # NaN until written, like an unread subpage
+        self._sequences = [0] * size
+        self._timestamps = [0.0] * size
+        self._newest = size - 1  # Slot index of the newest committed frame
+        self.sequence = 0  # Sequence number of the newest committed frame, 0 before the first commit
+        self._ready = threading.Condition()
+
+    def write_slot(self):
+        """Return the slot index and buffer the writer should fill next"""
+        index = (self._newest + 1) % self.size
+        return index, self._frames[index]
+
+    def commit(self, index:int, timestamp:float = None):
+        """Publish the filled slot as the newest frame and wake any waiting readers"""
+        with self._ready:
+            self.sequence += 1
+            self._sequences[index] = self.sequence
+            self._timestamps[index] = time.monotonic() if timestamp is None else timestamp
+            self._newest = index
+            self._ready.notify_all()
+
+    def latest(self, out=None):
+        """
+        Return (sequence, timestamp, frame) for the newest frame. The frame is a view, valid until size-1
+        more commits, unless out is given: then the frame is copied into out, which is returned instead.
+        """
+        with self._ready:
+            index = self._newest
+            frame = self._frames[index]
+            if out is not None:
+                np.copyto(out, frame.reshape(out.shape))
+                frame = out
+            return self._sequences[index], self._timestamps[index], frame
+
+    def wait_for(self, sequence:int, timeout:float = None):
+        """Block until a frame newer than sequence is committed. Returns False on timeout."""
+        with self._ready:
+            return self._ready.wait_for(lambda: self.sequence > sequence, timeout)
+
+
+class FrameSlot:
+    """
+    The newest frame from one capture thread, tagged with a sequence number.
+
+    publish() replaces the frame and wakes every thread waiting on the slot's Condition, so readers
+    sleep until a new frame exists instead of polling. Published frames are shared, not copied, and
+    must not be modified afterwards. Give several slots the same Condition to wait on any of them
+    with wait_for_new(), or for the newest frames of all of them with newest_frames().
+    """
+
+    def __init__(self, ready:threading.Condition = None):
+        self.ready = threading.Condition() if ready is None else ready
+        self.sequence = 0  # Sequence number of the newest frame, 0 before the first publish
+        self.timestamp = 0.0
+        self._frame = None
+
+    def publish(self, frame, timestamp:float = None):
+        """Make frame the newest one and wake any waiting readers"""
+        with self.ready:
+            self._frame = frame
+            self.sequence += 1
+            self.timestamp = time.monotonic() if timestamp is None else timestamp
+            self.ready.notify_all()
+
+    def latest(self):
+        """Return (sequence, frame) for the newest frame; frame is None before the first publish"""
+        with self.ready:
+            return self.sequence, self._frame
+
+    def wait_for(self, sequence:int, timeout:float = None):
+        """Block until a frame newer than sequence is published. Returns False on timeout."""
+        with self.ready:
+            return self.ready.wait_for(lambda: self.sequence > sequence, timeout)
+
+
+def wait_for_new(slots, sequences, timeout:float = None):
+    """
+    Block until any of slots has a frame newer than its entry in sequences. Returns False on timeout.
+    The slots must share one Condition.
+    """
+    ready = slots[0].ready
+    with ready:
+        return ready.wait_for(lambda: any(slot.sequence > seq for slot, seq in zip(slots, sequences)), timeout)
+
+
+def newest_frames(slots, seen:tuple, timeout:float = None):
+    """
+    Wait until any of slots has a frame newer than its entry in seen, then return (sequences, frames)
+    with the newest frame of every slot. frames is None on timeout or while a slot has no frame yet.
+    Pass sequences back as seen on the next call. The slots must share one Condition.
+    """
+    if not wait_for_new(slots, seen, timeout):
+        return seen, None
+    with slots[0].ready:  # Reentrant, so all slots are read at once
+        sequences, frames = zip(*(slot.latest() for slot in slots))
+    return sequences, None if any(frame is None for frame in frames) else frames
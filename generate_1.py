@@ -1,54 +1,46 @@
+import threading
+import cv2
+from pithermcam_fixed_temps import pithermalcam
+from therm_blend import HotRegions, FusionBlender
+from frame_ring import FrameSlot, newest_frames
+from jpeg_encoder import JpegEncoder
+from stream_hub import mjpeg_part
+
+# The HD capture thread publishes BGR frames to hd_frames; pull_thermal_images fills thermal_frames
+frames_ready = threading.Condition()  # generate() sleeps on it until either camera has a new frame
+hd_frames = FrameSlot(frames_ready)
+thermal_frames = FrameSlot(frames_ready)  # (image, (sequence, 24x32 temperatures in C))
+
+
+def pull_thermal_images():
+    """Publish each thermal image together with the temperatures it was rendered from"""
+    thermcam = pithermalcam(fixed_range=None)
+    while True:
+        image = thermcam.update_image_frame(size=(640, 480))
+        if image is not None:
+            thermal_frames.publish((image, thermcam.get_temperature_frame()))
+
+
 def generate():
-    global hd_output_frame, thermal_output_frame, hd_lock, thermal_lock
     alpha = 0.5  # Transparency factor for blending
-
-    # Define temperature range for the thermal camera
-    min_temp = 20.0  # Minimum temperature in °C
-    max_temp = 100.0  # Maximum temperature in °C
     threshold_temp = 40.0  # Temperature threshold in °C
 
-    # Calculate pixel value threshold
-    threshold_pixel_value = int((threshold_temp - min_temp) * 255 / (max_temp - min_temp))
+    # Regions above threshold_temp on the sensor temperatures, not on the colormap
+    hot_regions = HotRegions((640, 480), threshold_temp)
+    blender = FusionBlender((640, 480), 'regions', alpha)  # Reuses its buffers every frame
+    encoder = JpegEncoder()
+    seen = (0, 0)  # Sequence numbers of the HD and thermal frames last blended
 
     while True:
-        with hd_lock:
-            hd_frame = hd_output_frame.copy() if hd_output_frame is not None else None
-        with thermal_lock:
-            thermal_frame = thermal_output_frame.copy() if thermal_output_frame is not None else None
-        
-        if hd_frame is None or thermal_frame is None:
+        seen, frames = newest_frames((hd_frames, thermal_frames), seen, timeout=1.0)
+        if frames is None:
             continue
+        hd_frame, (thermal_frame, temps) = frames
 
-        # Ensure both frames have the same dimensions
-        hd_frame = cv2.resize(hd_frame, (640, 480))
-        thermal_frame = cv2.resize(thermal_frame, (640, 480))
-
-        # Convert thermal frame to grayscale to process temperature values
-        thermal_gray = cv2.cvtColor(thermal_frame, cv2.COLOR_BGR2GRAY)
-
-        # Create masks for pixels above and below the threshold
-        above_threshold_mask = thermal_gray >= threshold_pixel_value
-        below_threshold_mask = ~above_threshold_mask
+        # Resize straight into the blender; both frames must be 640x480 BGR
+        cv2.resize(hd_frame, (640, 480), dst=blender.base)
+        cv2.resize(thermal_frame, (640, 480), dst=blender.overlay)
 
-        # Create 3-channel masks for blending
-        above_threshold_mask_3c = np.stack([above_threshold_mask] * 3, axis=-1)
-        below_threshold_mask_3c = np.stack([below_threshold_mask] * 3, axis=-1)
-
-        # Ensure both frames have the same number of channels
-        if len(hd_frame.shape) == 2:
-            hd_frame = cv2.cvtColor(hd_frame, cv2.COLOR_GRAY2BGR)
-        if len(thermal_frame.shape) == 2:
-            thermal_frame = cv2.cvtColor(thermal_frame, cv2.COLOR_GRAY2BGR)
-
-        # Apply alpha blending to create translucent effect for pixels above the threshold
-        blended_above_threshold = cv2.addWeighted(thermal_frame, alpha, hd_frame, 1 - alpha, 0)
-
-        # Combine the frames using the masks
-        blended_frame = np.where(above_threshold_mask_3c, blended_above_threshold, hd_frame)
-
-        # Encode the blended frame
-        (flag, encoded_image) = cv2.imencode(".jpg", blended_frame)
-        if not flag:
-            continue
-        
-        yield (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + bytearray(encoded_image) + b'\r\n')
+        # Blend the thermal frame over the hot regions only; cold pixels aren't touched
+        hot_regions.update(temps[1], temps[0])
+        yield mjpeg_part(encoder.encode(blender.blend(regions=hot_regions)))
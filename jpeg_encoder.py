@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/python3
+##################################
+# JPEG encoding for the MJPEG streams, from BGR frames or Picamera2 YUV420 arrays
+##################################
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+try:  # libjpeg-turbo bindings, installed with Picamera2
+    import simplejpeg
+except ImportError:  # Falls back to cv2.imencode
+    simplejpeg = None
+
+SUBSAMPLINGS = {'444': 0x111111, '422': 0x211111, '420': 0x221111}  # cv2.IMWRITE_JPEG_SAMPLING_FACTOR values
+ENCODER_BACKENDS = ['simplejpeg', 'cv2']
+_MCU_ROWS = 16  # Slice heights are multiples of the largest MCU height, 16 rows for 4:2:0
+
+
+def _split_jpeg(jpeg:bytes):
+    """Return (header segments before SOS, SOS segment, entropy-coded data) of a baseline JPEG"""
+    segments = []
+    i = 2  # After SOI
+    while True:
+        marker = jpeg[i:i + 2]
+        end = i + 2 + int.from_bytes(jpeg[i + 2:i + 4], 'big')
+        if marker == b'\xff\xda':
+            return segments, jpeg[i:end], jpeg[end:-2]  # Data runs up to EOI
+        segments.append(jpeg[i:end])
+        i = end
+
+
+def _join_slices(slices:list, height:int):
+    """
+    Join JPEGs of horizontal stripes, all as high as the first but the last, into one JPEG with a restart
+    marker between stripes. Returns None if the stripes can't be joined: differing tables, or a stripe
+    height that isn't a whole number of MCU rows.
+    """
+    header, sos, data = _split_jpeg(slices[0])
+    is_sof = lambda segment: segment[1] == 0xc0
+    sof = next((segment for segment in header if is_sof(segment)), None)
+    if sof is None:  # Not baseline
+        return None
+    rows, width = int.from_bytes(sof[5:7], 'big'), int.from_bytes(sof[7:9], 'big')
+    factors = sof[11:10 + 3 * sof[9]:3]  # Sampling factors of each component, horizontal << 4 | vertical
+    mcu_width, mcu_height = 8 * max(f >> 4 for f in factors), 8 * max(f & 15 for f in factors)
+    interval = -(-width // mcu_width) * (rows // mcu_height)
+    if rows % mcu_height or interval > 0xffff:
+        return None
+    tables = [segment for segment in header if not is_sof(segment)]
+    parts = [data]
+    for jpeg in slices[1:]:
+        other_header, other_sos, data = _split_jpeg(jpeg)
+        if other_sos != sos or [segment for segment in other_header if not is_sof(segment)] != tables:
+            return None
+        parts.append(data)
+    # A restart marker resets the DC predictors and byte-aligns, exactly like the start of each stripe's scan
+    body = bytearray()
+    for index, data in enumerate(parts):
+        if index:
+            body += bytes((0xff, 0xd0 + (index - 1) % 8))
+        body += data
+    header = [sof[:5] + height.to_bytes(2, 'big') + sof[7:] if is_sof(segment) else segment for segment in header]
+    restart = b'\xff\xdd\x00\x04' + interval.to_bytes(2, 'big')
+    return b'\xff\xd8' + b''.join(header) + restart + sos + bytes(body) + b'\xff\xd9'
+
+
+class JpegEncoder:
+    """
+    Encode BGR frames, or packed full-range YUV420 (I420) arrays as Picamera2 captures with format "YUV420".
+
+    backend is 'simplejpeg' (libjpeg-turbo) when installed, else 'cv2'. simplejpeg takes YUV420 planes
+    directly, skipping any RGB conversion; cv2 needs them converted to BGR first. quality is 1-100 and
+    subsampling one of SUBSAMPLINGS (YUV input is always 4:2:0).
+
+    With slices > 1 each frame is cut into horizontal stripes that are encoded in parallel threads,
+    both backends releasing the GIL, and joined into one standard baseline JPEG with a restart marker
+    between stripes. Frames too small to split are encoded whole.
+    """
+
+    def __init__(self, quality:int = 95, subsampling:str = '420', slices:int = 1, backend:str = None):
+        if subsampling not in SUBSAMPLINGS:
+            raise ValueError(f"Unknown subsampling {subsampling}, expected one of {list(SUBSAMPLINGS)}")
+        if backend is None:
+            backend = 'simplejpeg' if simplejpeg is not None else 'cv2'
+        if backend not in ENCODER_BACKENDS:
+            raise ValueError(f"Unknown encoder backend {backend}, expected one of {ENCODER_BACKENDS}")
+        if backend == 'simplejpeg' and simplejpeg is None:
+            raise ValueError("The simplejpeg backend needs the simplejpeg package")
+        self.quality = quality
+        self.subsampling = subsampling
+        self.slices = slices
+        self.backend = backend
+        self._params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        if hasattr(cv2, 'IMWRITE_JPEG_SAMPLING_FACTOR'):  # OpenCV 4.7 and later
+            self._params += [cv2.IMWRITE_JPEG_SAMPLING_FACTOR, SUBSAMPLINGS[subsampling]]
+        self._pool = ThreadPoolExecutor(slices) if slices > 1 else None
+
+    def encode(self, frame):
+        """Return the JPEG bytes of a BGR frame"""
+        return self._encode_sliced(frame.shape[0], lambda top, bottom: self._encode_bgr(frame[top:bottom]))
+
+    def encode_yuv420(self, frame):
+        """Return the JPEG bytes of a packed (height * 3 // 2, width) YUV420 array"""
+        height, width = frame.shape[0] * 2 // 3, frame.shape[1]
+        planes = frame.reshape(-1)
+        y = planes[:height * width].reshape(height, width)
+        u = planes[height * width:height * width * 5 // 4].reshape(height // 2, width // 2)
+        v = planes[height * width * 5 // 4:].reshape(height // 2, width // 2)
+        return self._encode_sliced(height, lambda top, bottom: self._encode_yuv(y[top:bottom], u[top // 2:bottom // 2], v[top // 2:bottom // 2]))
+
+    def _encode_sliced(self, height:int, encode_rows):
+        rows = -(-height // self.slices // _MCU_ROWS) * _MCU_ROWS if self.slices > 1 else height
+        if rows >= height:
+            return encode_rows(0, height)
+        slices = list(self._pool.map(lambda top: encode_rows(top, min(top + rows, height)), range(0, height, rows)))
+        jpeg = _join_slices(slices, height)
+        return encode_rows(0, height) if jpeg is None else jpeg
+
+    def _encode_bgr(self, bgr):
+        if self.backend == 'simplejpeg':
+            return simplejpeg.encode_jpeg(np.ascontiguousarray(bgr), self.quality, 'BGR', self.subsampling)
+        (flag, encoded_image) = cv2.imencode(".jpg", bgr, self._params)
+        if not flag:
+            raise ValueError("cv2.imencode failed")
+        return encoded_image.tobytes()
+
+    def _encode_yuv(self, y, u, v):
+        if self.backend == 'simplejpeg':
+            return simplejpeg.encode_jpeg_yuv_planes(y, u, v, self.quality)
+        # Full range like JPEG itself and Picamera2's sYCC; cv2's I420 conversions assume video range
+        size = (y.shape[1], y.shape[0])
+        u, v = cv2.resize(u, size, interpolation=cv2.INTER_LINEAR), cv2.resize(v, size, interpolation=cv2.INTER_LINEAR)
+        (flag, encoded_image) = cv2.imencode(".jpg", cv2.cvtColor(cv2.merge((y, v, u)), cv2.COLOR_YCrCb2BGR), self._params)
+        if not flag:
+            raise ValueError("cv2.imencode failed")
+        return encoded_image.tobytes()
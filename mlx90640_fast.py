@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/python3
+##################################
+# Vectorized MLX90640 temperature calculation
+##################################
+import os, json, zlib, time
+import logging
+import numpy as np
+import adafruit_mlx90640
+from adafruit_bus_device.i2c_device import I2CDevice
+
+logger = logging.getLogger(__name__)
+
+SCALEALPHA = 0.000001
+KELVIN = 273.15
+CALIBRATION_CACHE_VERSION = 1
+# Attributes set by the driver's _ExtractParameters, saved to and loaded from the calibration cache
+CALIBRATION_ATTRS = ['kVdd', 'vdd25', 'KvPTAT', 'KtPTAT', 'vPTAT25', 'alphaPTAT', 'gainEE', 'tgc', 'KsTa',
+                     'resolutionEE', 'calibrationModeEE', 'ksTo', 'ct', 'alpha', 'alphaScale', 'offset', 'kta',
+                     'ktaScale', 'kv', 'kvScale', 'cpAlpha', 'cpOffset', 'ilChessC', 'brokenPixels',
+                     'outlierPixels', 'cpKta', 'cpKv']
+
+
+def _to_signed(word):
+    """Convert a 16 bit sensor word to a signed int"""
+    return word - 65536 if word > 32767 else word
+
+
+class MLX90640Fast(adafruit_mlx90640.MLX90640):
+    """
+    Drop-in replacement for adafruit_mlx90640.MLX90640.
+
+    The EEPROM calibration parameters are parsed by the adafruit driver as usual, then copied into
+    NumPy arrays once so the per-frame To calculation runs as a handful of array ops instead of a
+    Python loop over all 768 pixels. getFrame() keeps its signature; get_frame_array() returns a
+    24x32 float32 array directly. Pixels whose math is out of range come back as NaN rather than
+    raising ValueError.
+
+    get_subpage_frame() reads a single chess/interleave subpage per call, so a frame buffer can be
+    refreshed twice per full sensor frame.
+
+    If cache_folder is given, the parsed calibration is saved there keyed by the sensor serial number
+    and reloaded on the next start instead of re-reading and re-parsing the whole EEPROM.
+
+    Subpages are read in fewer I2C transactions than the driver uses: status polls are paced by the
+    refresh rate, the ready flag is cleared without a read-back, and the status and control
+    registers are read together in one block after the RAM.
+    """
+    emissivity = 0.95
+    polls_per_subpage = 16  # Status polls per subpage period while waiting for data
+    _subpage_period = 0.125
+
+    def __init__(self, i2c_bus, address=0x33, cache_folder:str = None):
+        self.i2c_device = I2CDevice(i2c_bus, address)
+        if cache_folder is None or not self._load_calibration(cache_folder):
+            self._I2CReadWords(0x2400, adafruit_mlx90640.eeData)
+            self._ExtractParameters()
+            if cache_folder is not None:
+                self._save_calibration(cache_folder)
+        self._build_calibration_arrays()
+        self._init_buffers()
+
+    def _init_buffers(self):
+        """Allocate the per-instance buffers reused by every read"""
+        self._frame_data = [0] * 834
+        self._measured = np.full(768, np.nan, dtype=np.float32)  # Last measured value of every pixel, NaN until first read
+        self._status = [0]
+        self._registers = [0] * 14  # Status (0x8000) through control (0x800D)
+
+    @property
+    def refresh_rate(self):
+        return super().refresh_rate
+
+    @refresh_rate.setter
+    def refresh_rate(self, rate):
+        adafruit_mlx90640.MLX90640.refresh_rate.fset(self, rate)
+        self._subpage_period = 1 / (0.5 * 2 ** rate)
+
+    def _GetFrameData(self, frameData):
+        """Read the next subpage's RAM into frameData in as few I2C transactions as possible"""
+        status = self._status
+        self._I2CReadWords(0x8000, status)
+        while not status[0] & 0x0008:
+            time.sleep(self._subpage_period / self.polls_per_subpage)
+            self._I2CReadWords(0x8000, status)
+
+        registers = self._registers
+        for _ in range(5):
+            with self.i2c_device as i2c:  # Clear the data ready flag; no read-back
+                i2c.write(bytes((0x80, 0x00, 0x00, 0x30)))
+            self._I2CReadWords(0x0400, frameData, end=832)
+            self._I2CReadWords(0x8000, registers)  # Status and control in one block
+            if not registers[0] & 0x0008:  # No new data arrived during the read
+                break
+        else:
+            raise RuntimeError("Too many retries")
+
+        frameData[832] = registers[13]
+        frameData[833] = registers[0] & 0x0001
+        return frameData[833]
+
+    def probe_bus(self):
+        """One frame-sized RAM read, used to measure how reliable the I2C bus is"""
+        self._I2CReadWords(0x0400, self._frame_data, end=832)
+
+    def _calibration_key(self, header):
+        """Return the cache file name and a checksum for the first 64 EEPROM words, which hold the serial number"""
+        serial = header[7:10]  # Device ID words at 0x2407-0x2409
+        fname = 'mlx90640_calibration_' + ''.join(f'{word:04x}' for word in serial) + '.json'
+        return fname, zlib.crc32(bytes(str(list(header[:64])), 'ascii'))
+
+    def _load_calibration(self, cache_folder:str):
+        """Load cached calibration parameters. Returns False if there is no valid cache for this sensor."""
+        header = [0] * 64  # One short read instead of the full 832 word EEPROM
+        self._I2CReadWords(0x2400, header)
+        try:
+            fname, header_crc = self._calibration_key(header)
+            with open(os.path.join(cache_folder, fname)) as f:
+                cache = json.load(f)
+            if cache.get('version') != CALIBRATION_CACHE_VERSION or cache.get('header_crc') != header_crc:
+                logger.info("Calibration cache %s is stale; reading EEPROM", fname)
+                return False
+            self._apply_calibration(cache['params'])
+        except (OSError, ValueError, KeyError):
+            logger.info("No usable calibration cache; reading EEPROM")
+            return False
+        return True
+
+    def _apply_calibration(self, params:dict):
+        """Set the driver's calibration attributes from a dict of cached parameters"""
+        for attr in CALIBRATION_ATTRS:
+            setattr(self, attr, params[attr])
+
+    @classmethod
+    def from_calibration_file(cls, fname:str):
+        """
+        Build an instance from a cached calibration file without any I2C bus, e.g. to convert
+        raw frames with convert_raw_frames() in a worker process or on another machine.
+        """
+        with open(fname) as f:
+            cache = json.load(f)
+        mlx = cls.__new__(cls)
+        mlx.i2c_device = None
+        mlx._apply_calibration(cache['params'])
+        mlx._build_calibration_arrays()
+        mlx._init_buffers()
+        return mlx
+
+    def _save_calibration(self, cache_folder:str):
+        """Save the parsed calibration parameters to the cache folder"""
+        try:
+            fname, header_crc = self._calibration_key(adafruit_mlx90640.eeData)
+            os.makedirs(cache_folder, exist_ok=True)
+            params = {attr: getattr(self, attr) for attr in CALIBRATION_ATTRS}
+            params['brokenPixels'] = list(params['brokenPixels'])
+            params['outlierPixels'] = list(params['outlierPixels'])
+            with open(os.path.join(cache_folder, fname), 'w') as f:
+                json.dump({'version': CALIBRATION_CACHE_VERSION, 'header_crc': header_crc, 'params': params}, f)
+        except OSError:
+            logger.warning("Could not save calibration cache to %s", cache_folder)
+
+    def _build_calibration_arrays(self):
+        """Copy the parsed calibration parameters into arrays used by _CalculateTo"""
+        pixels = np.arange(768)
+        il_pattern = (pixels // 32) % 2
+        chess_pattern = il_pattern ^ (pixels % 2)
+        conversion_pattern = ((pixels + 2) // 4 - (pixels + 3) // 4 + (pixels + 1) // 4 - pixels // 4) * (1 - 2 * il_pattern)
+
+        self._offset_arr = np.asarray(self.offset[:768], dtype=np.float64)
+        self._kta_arr = np.asarray(self.kta[:768], dtype=np.float64) / 2 ** self.ktaScale
+        self._kv_arr = np.asarray(self.kv[:768], dtype=np.float64) / 2 ** self.kvScale
+        with np.errstate(divide='ignore'):
+            self._alpha_arr = SCALEALPHA * 2 ** self.alphaScale / np.asarray(self.alpha[:768], dtype=np.float64)
+        self._il_correction = self.ilChessC[2] * (2 * il_pattern - 1) - self.ilChessC[1] * conversion_pattern
+
+        self._bad_pixels = np.zeros(768, dtype=bool)
+        self._bad_pixels[list(self.brokenPixels) + list(self.outlierPixels)] = True
+
+        # Pixels read in each subpage, indexed [chess mode][subpage], with bad pixels left out
+        self._subpage_masks = np.array([[(pattern == sub_page) & ~self._bad_pixels for sub_page in range(2)]
+                                        for pattern in (il_pattern, chess_pattern)])
+
+        self._ct_arr = np.asarray(self.ct[:4], dtype=np.float64)
+        self._ks_to_arr = np.asarray(self.ksTo[:4], dtype=np.float64)
+        alpha_corr_r = [1 / (1 + self.ksTo[0] * 40), 1, 1 + self.ksTo[1] * self.ct[2]]
+        alpha_corr_r.append(alpha_corr_r[2] * (1 + self.ksTo[2] * (self.ct[3] - self.ct[2])))
+        self._alpha_corr_r = np.asarray(alpha_corr_r, dtype=np.float64)
+
+    def _CalculateTo(self, frameData, emissivity, tr, result):
+        """Vectorized version of the driver's per-pixel object temperature calculation"""
+        sub_page = frameData[833]
+        vdd = self._GetVdd(frameData)
+        ta = self._GetTa(frameData)
+
+        ta4 = (ta + KELVIN) ** 4
+        tr4 = (tr + KELVIN) ** 4
+        ta_tr = tr4 - (tr4 - ta4) / emissivity
+
+        gain = self.gainEE / _to_signed(frameData[778])
+        mode = (frameData[832] & 0x1000) >> 5
+
+        # Compensation pixel for the current subpage
+        cp_scale = (1 + self.cpKta * (ta - 25)) * (1 + self.cpKv * (vdd - 3.3))
+        if sub_page == 0:
+            ir_cp = _to_signed(frameData[776]) * gain - self.cpOffset[0] * cp_scale
+        elif mode == self.calibrationModeEE:
+            ir_cp = _to_signed(frameData[808]) * gain - self.cpOffset[1] * cp_scale
+        else:
+            ir_cp = _to_signed(frameData[808]) * gain - (self.cpOffset[1] + self.ilChessC[0]) * cp_scale
+
+        mask = self._subpage_masks[int(mode != 0), sub_page]
+        ir = np.asarray(frameData[:768], dtype=np.uint16).view(np.int16)[mask] * gain
+        ir -= self._offset_arr[mask] * (1 + self._kta_arr[mask] * (ta - 25)) * (1 + self._kv_arr[mask] * (vdd - 3.3))
+        if mode != self.calibrationModeEE:
+            ir += self._il_correction[mask]
+        ir -= self.tgc * ir_cp
+        ir /= emissivity
+
+        alpha = self._alpha_arr[mask] * (1 + self.KsTa * (ta - 25))
+        to = self._object_temperature(ir, alpha, ta_tr)
+
+        if isinstance(result, np.ndarray):
+            out = result.reshape(-1)  # A view for the usual (768,) or (24,32) buffers
+            out[mask] = to
+            out[self._bad_pixels] = -KELVIN
+        else:
+            for pixel, value in zip(np.flatnonzero(mask).tolist(), to.tolist()):
+                result[pixel] = value
+            for pixel in np.flatnonzero(self._bad_pixels).tolist():
+                result[pixel] = -KELVIN
+
+    def _object_temperature(self, ir, alpha, ta_tr):
+        """Final To step on compensated IR data and alphas of any matching shape"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sx = np.sqrt(np.sqrt(alpha * alpha * alpha * (ir + alpha * ta_tr))) * self.ksTo[1]
+            to = np.sqrt(np.sqrt(ir / (alpha * (1 - self.ksTo[1] * KELVIN) + sx) + ta_tr)) - KELVIN
+
+            # Recalculate with the correction for the temperature range each pixel falls in
+            to_range = np.searchsorted(self._ct_arr[1:], to, side='right')
+            return np.sqrt(np.sqrt(ir / (alpha * self._alpha_corr_r[to_range]
+                                         * (1 + self._ks_to_arr[to_range] * (to - self._ct_arr[to_range]))) + ta_tr)) - KELVIN
+
+    def get_frame_array(self, out=None):
+        """Read both subpages and return the temperatures as a 24x32 float32 array"""
+        if out is None:
+            out = np.zeros((24, 32), dtype=np.float32)
+        self.getFrame(out)
+        return out
+
+    def get_subpage_frame(self, out, motion_threshold:float = None):
+        """
+        Read the next subpage into out, keeping the other half from the previous subpage.
+        If motion_threshold (deg C) is set, stale pixels whose freshly read neighbours changed by more
+        than that are replaced by the mean of those neighbours. Returns the subpage number read.
+        """
+        frame_data = self._frame_data
+        if self._GetFrameData(frame_data) < 0:
+            raise RuntimeError("Frame data error")
+        sub_page = frame_data[833]
+        chess_mode = int((frame_data[832] & 0x1000) != 0)
+        tr = self._GetTa(frame_data) - adafruit_mlx90640.OPENAIR_TA_SHIFT
+
+        previous = self._measured.copy() if motion_threshold is not None else None
+        self._CalculateTo(frame_data, self.emissivity, tr, self._measured)
+
+        flat = out.reshape(-1)
+        flat[:] = self._measured
+        if motion_threshold is not None:
+            self._deinterlace(flat, previous, self._subpage_masks[chess_mode, sub_page],
+                              self._subpage_masks[chess_mode, 1 - sub_page], motion_threshold)
+        return sub_page
+
+    def _deinterlace(self, flat, previous, fresh, stale, motion_threshold):
+        """Replace stale pixels in moving areas with the mean of their fresh 4-neighbours"""
+        def neighbour_sum(a):
+            padded = np.pad(a, 1)
+            return padded[:-2, 1:-1] + padded[2:, 1:-1] + padded[1:-1, :-2] + padded[1:-1, 2:]
+
+        fresh = fresh.reshape(24, 32)
+        grid = flat.reshape(24, 32)
+        weights = fresh.astype(np.float32)
+        motion = np.where(fresh, np.abs(grid - previous.reshape(24, 32)), 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            count = neighbour_sum(weights)
+            moving = neighbour_sum(motion) / count > motion_threshold
+            replace = stale.reshape(24, 32) & moving
+            grid[replace] = (neighbour_sum(np.where(fresh, grid, 0)) / count)[replace]
+
+    def read_raw_subpage(self, out):
+        """
+        Read the next subpage's RAM without converting it. out receives the 834 raw words: the 832 RAM
+        words, which include the Ta and Vdd readings, then the control register and the subpage number.
+        """
+        if self._GetFrameData(self._frame_data) < 0:
+            raise RuntimeError("Frame data error")
+        out[:] = self._frame_data
+        return self._frame_data[833]
+
+    def convert_raw_frames(self, raw_frames, out=None):
+        """
+        Convert N raw subpages from read_raw_subpage() to N merged 24x32 float32 temperature frames in one
+        vectorized pass. Each output frame holds its own subpage plus the other half from the subpage
+        before it, as getFrame() would; the first frame's other half is NaN.
+        """
+        words = np.asarray(raw_frames, dtype=np.uint16).reshape(-1, 834)
+        signed = words.view(np.int16).astype(np.float64)
+        control = words[:, 832].astype(np.int64)
+        sub_page = words[:, 833] & 1
+        mode = (control & 0x1000) >> 5
+
+        # Per-frame Vdd, Ta and reflected temperature, as _GetVdd/_GetTa do for one frame
+        resolution_correction = 2.0 ** self.resolutionEE / 2.0 ** ((control & 0x0C00) >> 10)
+        vdd = (resolution_correction * signed[:, 810] - self.vdd25) / self.kVdd + 3.3
+        ptat = signed[:, 800]
+        ptat_art = ptat / (ptat * self.alphaPTAT + signed[:, 768]) * 2 ** 18
+        ta = (ptat_art / (1 + self.KvPTAT * (vdd - 3.3)) - self.vPTAT25) / self.KtPTAT + 25
+        tr = ta - adafruit_mlx90640.OPENAIR_TA_SHIFT
+        tr4 = (tr + KELVIN) ** 4
+        ta_tr = tr4 - (tr4 - (ta + KELVIN) ** 4) / self.emissivity
+
+        gain = self.gainEE / signed[:, 778]
+        cp_scale = (1 + self.cpKta * (ta - 25)) * (1 + self.cpKv * (vdd - 3.3))
+        cp_offset_1 = self.cpOffset[1] + np.where(mode == self.calibrationModeEE, 0, self.ilChessC[0])
+        ir_cp = np.where(sub_page == 0, signed[:, 776] * gain - self.cpOffset[0] * cp_scale,
+                         signed[:, 808] * gain - cp_offset_1 * cp_scale)
+
+        ir = signed[:, :768] * gain[:, None]
+        ir -= self._offset_arr * (1 + self._kta_arr * (ta - 25)[:, None]) * (1 + self._kv_arr * (vdd - 3.3)[:, None])
+        ir += np.where((mode != self.calibrationModeEE)[:, None], self._il_correction, 0)
+        ir -= self.tgc * ir_cp[:, None]
+        ir /= self.emissivity
+        alpha = self._alpha_arr * (1 + self.KsTa * (ta - 25))[:, None]
+        to = self._object_temperature(ir, alpha, ta_tr[:, None])
+
+        # Merge each subpage with the previous one, as consecutive getFrame() subpages would be
+        if out is None:
+            out = np.empty((len(words), 24, 32), dtype=np.float32)
+        flat = out.reshape(len(words), 768)
+        masks = self._subpage_masks[(mode != 0).astype(int), sub_page]
+        previous = np.full(768, np.nan, dtype=np.float32)
+        for n in range(len(words)):
+            previous = flat[n] = np.where(masks[n], to[n], previous)
+        flat[:, self._bad_pixels] = -KELVIN
+        return out
+
+
+class RawFrameLog:
+    """
+    Compact, preallocated store of raw subpages (834 uint16 words each, ~1.6 kB) with capture
+    timestamps, for recording at the full sensor rate and converting to temperatures later.
+    """
+
+    def __init__(self, capacity:int):
+        self.words = np.zeros((capacity, 834), dtype=np.uint16)
+        self.timestamps = np.zeros(capacity)
+        self.count = 0
+
+    def capture(self, mlx:MLX90640Fast):
+        """Read one raw subpage into the log. Returns False once the log is full."""
+        if self.count == len(self.words):
+            return False
+        mlx.read_raw_subpage(self.words[self.count])
+        self.timestamps[self.count] = time.time()
+        self.count += 1
+        return True
+
+    def save(self, fname:str):
+        """Save the captured subpages to an .npz file"""
+        np.savez(fname, words=self.words[:self.count], timestamps=self.timestamps[:self.count])
+
+    @classmethod
+    def load(cls, fname:str):
+        """Load a log saved with save()"""
+        with np.load(fname) as data:
+            log = cls(len(data['words']))
+            log.words[:] = data['words']
+            log.timestamps[:] = data['timestamps']
+        log.count = len(log.words)
+        return log
+
+
+def convert_raw_log(calibration_file:str, log_file:str):
+    """
+    Convert a saved RawFrameLog to (timestamps, temperatures) using a cached calibration file.
+    Needs no sensor, so it can run in a multiprocessing worker or on another machine.
+    """
+    log = RawFrameLog.load(log_file)
+    mlx = MLX90640Fast.from_calibration_file(calibration_file)
+    return log.timestamps, mlx.convert_raw_frames(log.words)
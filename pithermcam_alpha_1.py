@@ -11,6 +11,7 @@ import cv2
 import logging
 import cmapy
 from scipy import ndimage
+from therm_stats import FrameStats
 
 # Set up logging
 logging.basicConfig(filename='pithermcam.log', filemode='a',
@@ -30,6 +31,8 @@ class pithermalcam:
     _temp_max = None
     _raw_image = None
     _image = None
+    _frame_seq = 0  # Sequence number of the frame in _raw_image
+    _stats = None  # FrameStats of the frame in _raw_image, shared by the HUD and the transparency check
     _file_saved_notification_start = None
     _displaying_onscreen = False
     _exit_requested = False
@@ -68,17 +71,25 @@ class pithermalcam:
         """Update the image frame from the thermal camera"""
         try:
             self._raw_image = np.zeros((24, 32), dtype=float)
-            self.mlx.getFrame(self._raw_image)
-            self._temp_min = np.min(self._raw_image)
-            self._temp_max = np.max(self._raw_image)
+            self.mlx.getFrame(self._raw_image.reshape(-1))  # flat view, the driver indexes by pixel number
+            self._frame_seq += 1
+            stats = self.get_frame_stats()
+            self._temp_min = stats.min
+            self._temp_max = stats.max
             self._current_frame_processed = False
         except Exception as e:
             logger.error("Error updating image frame: %s", e)
             traceback.print_exc()
 
+    def get_frame_stats(self):
+        """Statistics of the current frame, computed once per frame and shared by all callers. Never reads the sensor itself."""
+        if self._stats is None or self._stats.sequence != self._frame_seq:
+            self._stats = FrameStats(self._raw_image, self._frame_seq, time.monotonic())
+        return self._stats
+
     def get_mean_temp(self):
-        """Calculate and return the mean temperature of the image"""
-        temp_c = np.mean(self._raw_image)
+        """Return the mean temperature of the current frame in C and F, from its cached statistics"""
+        temp_c = self.get_frame_stats().mean
         temp_f = self._c_to_f(temp_c)
         return temp_c, temp_f
 
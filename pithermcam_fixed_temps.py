@@ -3,14 +3,20 @@
 ##################################
 # MLX90640 Thermal Camera w Raspberry Pi
 ##################################
-import time,board,busio, traceback
+import time,board,busio, traceback, threading, collections
 import numpy as np
 import adafruit_mlx90640
 import datetime as dt
 import cv2
 import logging
-import cmapy
 from scipy import ndimage
+from mlx90640_fast import MLX90640Fast, RawFrameLog
+from frame_ring import FrameRing
+from sensor_tuning import RefreshRateController, I2CFrequencyTuner
+from therm_filters import GridPrefilter, TemporalFilter
+from therm_stats import FrameStats
+from therm_render import SeparableResampler, FloatColorizer, HudOverlay, colormap_lut, colormap_table, draw_text, premultiplied_bgra
+from adafruit_bus_device.i2c_device import I2CDevice
 
 # Set up logging
 logging.basicConfig(filename='pithermcam.log',filemode='a',
@@ -18,35 +24,85 @@ logging.basicConfig(filename='pithermcam.log',filemode='a',
                     level=logging.WARNING,datefmt='%d-%b-%y %H:%M:%S')
 logger = logging.getLogger(__name__)
 
+I2C_CLOCK_FILE = '/sys/class/i2c-adapter/i2c-1/of_node/clock-frequency'  # Bus speed set by dtparam=i2c_arm_baudrate
+
 
 class pithermalcam:
     # See https://gitlab.com/cvejarano-oss/cmapy/-/blob/master/docs/colorize_all_examples.md to for options that can be put in this list
     _colormap_list=['jet','bwr','seismic','coolwarm','PiYG_r','tab10','tab20','gnuplot2','brg']
-    _interpolation_list =[cv2.INTER_NEAREST,cv2.INTER_LINEAR,cv2.INTER_AREA,cv2.INTER_CUBIC,cv2.INTER_LANCZOS4,5,6]
-    _interpolation_list_name = ['Nearest','Inter Linear','Inter Area','Inter Cubic','Inter Lanczos4','Pure Scipy', 'Scipy/CV2 Mixed']
+    _interpolation_list =[cv2.INTER_NEAREST,cv2.INTER_LINEAR,cv2.INTER_AREA,cv2.INTER_CUBIC,cv2.INTER_LANCZOS4,5,6,7]
+    _interpolation_list_name = ['Nearest','Inter Linear','Inter Area','Inter Cubic','Inter Lanczos4','Pure Scipy', 'Scipy/CV2 Mixed', 'Separable Spline']
     _current_frame_processed=False  # Tracks if the current processed image matches the current raw image
     i2c=None
     mlx=None
+    refresh_controller=None  # Adjusts the sensor refresh rate when adaptive_refresh is set
+    i2c_tuner=None  # Picks and backs off the I2C frequency when tune_i2c is set
     _temp_min=None
     _temp_max=None
+    _temps=None  # Float temperatures in C, source of _raw_image
+    _display_temps=None  # _temps after the grid filter, what gets rendered
+    _prefilter=None  # Grid filter used when filter_image is set and filter_mode isn't 'bilateral'
+    _grid_smooth=None  # Stands in for the bilateral filter on the float path, which has no 8-bit image to filter cheaply
+    _temporal_filter=None  # Noise reduction across frames, applied to every frame read when temporal_filter is set
     _raw_image=None
     _image=None
+    _colormap=None  # LUT for the current colormap, swapped by change_colormap
+    _renderers=None  # Per output size (width, height): spline resampler, float colorizer and HUD overlay
+    _sized_images=None  # Per output size: (frame sequence, image) rendered by update_image_frame(size=...)
+    _bgra_images=None  # Per (size, transparent_c, opaque_c): (frame sequence, premultiplied BGRA image)
+    _hud_text=None  # (numbers, settings) status text of the current frame
+    _hud_seq=None  # Frame sequence _hud_text was formatted for
+    _ring=None  # Frame ring filled by the acquisition thread when threaded
+    _acquisition_thread=None
+    _frame_seq=0  # Sequence number of the frame in _temps
+    _frame_time=None  # Capture time (time.monotonic) of the frame in _temps
+    _stats=None  # FrameStats of the frame in _temps, computed on first request
+    _frame_times=None  # time.monotonic() of the last frames given a HUD, for the FPS
+    _fps=0.0
     _file_saved_notification_start=None
     _displaying_onscreen=False
     _exit_requested=False
 
     def __init__(self,use_f:bool = True, filter_image:bool = False, image_width:int=1200, 
-                image_height:int=900, output_folder:str = '/home/pi/pithermalcam/saved_snapshots/'):
+                image_height:int=900, output_folder:str = '/home/pi/pithermalcam/saved_snapshots/',
+                fast_calc:bool = True, subpage_mode:bool = False, deinterlace_threshold:float = None,
+                calibration_folder:str = '/home/pi/pithermalcam/calibration/', threaded:bool = False,
+                adaptive_refresh:bool = False, i2c_frequency:int = 800000, tune_i2c:bool = False,
+                filter_mode:str = 'bilateral', temporal_filter:str = None, fixed_range:tuple = (20, 80)):
         self.use_f=use_f
         self.filter_image=filter_image
+        self.filter_mode=filter_mode  # 'bilateral' filters the rendered image; 'median', 'smooth' or 'clahe' filter the 24x32 grid
+        if self.filter_mode != 'bilateral':
+            self._prefilter = GridPrefilter(self.filter_mode)
+        self.temporal_filter=temporal_filter  # None, 'ema', 'box' or 'adaptive' noise reduction of the temperatures themselves
+        if self.temporal_filter is not None:
+            self._temporal_filter = TemporalFilter(self.temporal_filter)
         self.image_width=image_width
         self.image_height=image_height
         self.output_folder=output_folder
+        self.fast_calc=fast_calc  # Use the vectorized To calculation instead of the driver's per-pixel loop
+        self.subpage_mode=subpage_mode  # Publish a frame after each subpage instead of after both
+        self.deinterlace_threshold=deinterlace_threshold  # Motion threshold in C for deinterlacing in subpage mode
+        self.calibration_folder=calibration_folder  # Where parsed EEPROM calibration is cached, None to always read it
+        if self.subpage_mode and not self.fast_calc:
+            raise ValueError("subpage_mode requires fast_calc")
+        self.threaded=threaded  # Read the sensor on a background thread; updates return the newest frame without blocking
+        self.adaptive_refresh=adaptive_refresh  # Step the refresh rate with demand, read time and I2C errors
+        self.i2c_frequency=i2c_frequency  # I2C clock in Hz, the starting point when tune_i2c is set
+        self.tune_i2c=tune_i2c  # Search for the fastest reliable I2C frequency at startup and back off on errors
+        self.fixed_range=fixed_range  # (min, max) C the colormap spans, or None to stretch it over each frame's range like upstream pithermalcam
 
         self._colormap_index = 0
+        self._colormap = colormap_lut(self._colormap_list[self._colormap_index])
         self._interpolation_index = 3
+        self._renderers = {}
+        self._sized_images = {}
+        self._bgra_images = {}
+        self._frame_times = collections.deque(maxlen=16)
+        self.register_output_size((800,600))
         self._setup_therm_cam()
-        self._t0 = time.time()
+        if self.threaded:
+            self._start_acquisition_thread()
         self.update_image_frame()
 
     def __del__(self):
@@ -55,44 +111,153 @@ class pithermalcam:
     def _setup_therm_cam(self):
         """Initialize the thermal camera"""
         # Setup camera
-        self.i2c = busio.I2C(board.SCL, board.SDA, frequency=800000)  # setup I2C
-        self.mlx = adafruit_mlx90640.MLX90640(self.i2c)  # begin MLX90640 with I2C comm
+        self.i2c = busio.I2C(board.SCL, board.SDA, frequency=self.i2c_frequency)  # setup I2C
+        if self.fast_calc:
+            self.mlx = MLX90640Fast(self.i2c, cache_folder=self.calibration_folder)  # begin MLX90640 with I2C comm, vectorized getFrame
+        else:
+            self.mlx = adafruit_mlx90640.MLX90640(self.i2c)  # begin MLX90640 with I2C comm
+        if self.tune_i2c:
+            state_file = None if self.calibration_folder is None else self.calibration_folder + 'i2c_frequency.json'
+            self.i2c_tuner = I2CFrequencyTuner(self._set_i2c_frequency, default=self.i2c_frequency, state_file=state_file)
+            if self.fast_calc:
+                probe = self.mlx.probe_bus
+            else:
+                probe = lambda: self.mlx._I2CReadWords(0x0400, [0] * 832)
+            self.i2c_frequency = self.i2c_tuner.tune(probe)  # The frequency in use, None if the bus can't report it
         self.mlx.refresh_rate = adafruit_mlx90640.RefreshRate.REFRESH_8_HZ  # set refresh rate
+        if self.adaptive_refresh:
+            self.refresh_controller = RefreshRateController(self.mlx, frame_subpages=1 if self.subpage_mode else 2)
+            self.refresh_controller.listeners.append(self._refresh_rate_changed)
         time.sleep(0.1)
 
+    def _set_i2c_frequency(self, frequency:int):
+        """Recreate the I2C bus at frequency and point the sensor at it. Returns the frequency the bus really runs at, None if unknown."""
+        self.i2c.deinit()
+        self.i2c = busio.I2C(board.SCL, board.SDA, frequency=frequency)
+        self.mlx.i2c_device = I2CDevice(self.i2c, 0x33)
+        self.i2c_frequency = self._bus_frequency()
+        return self.i2c_frequency
+
+    def _bus_frequency(self):
+        """The I2C clock in Hz: the kernel's setting on Linux, where busio ignores the frequency argument, else what the bus reports"""
+        try:
+            with open(I2C_CLOCK_FILE, 'rb') as f:
+                return int.from_bytes(f.read(4), 'big')  # Device tree cell, big-endian u32
+        except OSError:
+            return getattr(self.i2c, 'frequency', None)
+
+    def _refresh_rate_changed(self, old_hz:float, new_hz:float, reason:str):
+        """Restart the FPS window so the displayed FPS doesn't mix frames from both rates"""
+        self._frame_times.clear()  # Atomic, so safe from the acquisition thread
+
+    def set_client_count(self, clients:int):
+        """Tell the refresh rate controller how many viewers are connected"""
+        if self.refresh_controller is not None:
+            self.refresh_controller.set_clients(clients)
+
+    def _read_sensor(self, frame):
+        """Read one subpage in subpage mode or a whole frame otherwise into frame"""
+        try:
+            if self.subpage_mode:
+                self.mlx.get_subpage_frame(frame, self.deinterlace_threshold)
+            else:
+                self.mlx.getFrame(frame.reshape(-1))  # flat view, the driver indexes by pixel number
+        except (OSError, RuntimeError) as e:
+            if self.refresh_controller is not None:
+                self.refresh_controller.record_read(ok=False)
+            if self.i2c_tuner is not None:
+                self.i2c_tuner.record_error(e)
+            raise
+        if self.refresh_controller is not None:
+            self.refresh_controller.record_read()
+        if self.i2c_tuner is not None:
+            self.i2c_tuner.record()
+        if self._temporal_filter is not None:
+            self._temporal_filter(frame)
+
+    def _start_acquisition_thread(self):
+        """Start reading frames into the ring buffer on a background thread and wait for the first one"""
+        self._ring = FrameRing()
+        self._acquisition_thread = threading.Thread(target=self._acquisition_loop, daemon=True)
+        self._acquisition_thread.start()
+        self._ring.wait_for(0)
+
+    def _acquisition_loop(self):
+        """Read frames into the ring buffer until exit is requested"""
+        while not self._exit_requested:
+            index, frame = self._ring.write_slot()
+            try:
+                self._read_sensor(frame)
+            except (ValueError, OSError, RuntimeError):
+                logger.info(traceback.format_exc())
+                continue
+            self._ring.commit(index)
+
     def _c_to_f(self,temp:float):
         """ Convert temperature from C to F """
         return ((9.0/5.0)*temp+32.0)
 
     def get_mean_temp(self):
         """
-        Get mean temp of entire field of view. Return both temp C and temp F.
+        Get mean temp of entire field of view in the current frame. Return both temp C and temp F.
         """
-        frame = np.zeros((24*32,))  # setup array for storing all 768 temperatures
-        while True:
-            try:
-                self.mlx.getFrame(frame)  # read MLX temperatures into frame var
-                break
-            except ValueError:
-                continue  # if error, just read again
-
-        temp_c = np.mean(frame)
+        temp_c = self.get_frame_stats().mean
         temp_f=self._c_to_f(temp_c)
         return temp_c, temp_f
 
+    def get_temperature_frame(self):
+        """Return (sequence, temperatures) of the current frame, temperatures as a 24x32 copy in C, unflipped"""
+        if self._ring is not None:
+            self._pull_raw_image()
+        return self._frame_seq, np.array(self._temps, dtype=np.float32).reshape(24,32)
+
+    def get_frame_stats(self):
+        """Statistics of the current frame, computed once per frame and shared by all callers. Never reads the sensor itself."""
+        if self._ring is not None:
+            self._pull_raw_image()  # Take the newest frame from the acquisition thread, if there is one
+        return self._frame_stats()
+
+    def _frame_stats(self):
+        if self._stats is None or self._stats.sequence != self._frame_seq:
+            self._stats = FrameStats(self._temps.reshape(24,32), self._frame_seq, self._frame_time)
+        return self._stats
+
     def _pull_raw_image(self):
         """Get one pull of the raw image data, converting temp units if necessary"""
         # Get image
-        self._raw_image = np.zeros((24*32,))
         try:
-            self.mlx.getFrame(self._raw_image)  # read mlx90640
-            # relative tempuratures 
-            #self._temp_min = np.min(self._raw_image)
-            #self._temp_max = np.max(self._raw_image)
-            # fixed tempuratures  
-            self._temp_min = 20
-            self._temp_max = 80
-            self._raw_image=self._temps_to_rescaled_uints(self._raw_image,self._temp_min,self._temp_max)
+            if self._ring is not None:  # Take the newest frame from the acquisition thread
+                if self._ring.sequence == self._frame_seq:
+                    return  # No new frame since the last pull
+                if self._temps is None:
+                    self._temps = np.empty((24*32,), dtype=np.float32)
+                # Copied, since the slot is rewritten a few frames later while this frame may still be rendered
+                self._frame_seq, self._frame_time, _ = self._ring.latest(self._temps)
+            elif self.subpage_mode:  # Read one subpage; the other half keeps its values from the last pull
+                if self._temps is None:
+                    self._temps = np.full((24*32,), np.nan, dtype=np.float32)  # The other subpage isn't read yet
+                self._read_sensor(self._temps)
+                self._frame_seq += 1
+                self._frame_time = time.monotonic()
+            else:
+                self._temps = np.zeros((24*32,))
+                self._read_sensor(self._temps)  # read mlx90640
+                self._frame_seq += 1
+                self._frame_time = time.monotonic()
+            if self.refresh_controller is not None:
+                self.refresh_controller.record_consumed()
+            if self.fixed_range is None:  # relative tempuratures
+                stats = self._frame_stats()
+                if stats.count:
+                    self._temp_min, self._temp_max = stats.min, max(stats.max, stats.min + 0.1)  # A uniform scene mustn't divide by zero
+                elif self._temp_min is None:
+                    self._temp_min, self._temp_max = 20, 80
+            else:  # fixed tempuratures
+                self._temp_min, self._temp_max = self.fixed_range
+            self._display_temps = self._temps
+            if self.filter_image and self._prefilter is not None:
+                self._display_temps = self._prefilter(self._temps,self._temp_min,self._temp_max)
+            self._raw_image=self._temps_to_rescaled_uints(self._display_temps,self._temp_min,self._temp_max)
             self._current_frame_processed=False  # Note that the newly updated raw frame has not been processed
         except ValueError:
             print("Math error; continuing...")
@@ -103,38 +268,83 @@ class pithermalcam:
             self._raw_image = np.zeros((24*32,))  # If something went wrong, make sure the raw image has numbers
             logger.info(traceback.format_exc())
 
-    def _process_raw_image(self):
-        """Process the raw temp data to a colored image. Filter if necessary"""
-        # Image processing
+    def register_output_size(self, size:tuple):
+        """Prepare to render at size (width, height), so update_image_frame(size=size) doesn't build anything on first use"""
+        size = tuple(size)
+        if size not in self._renderers:
+            scale = size[0] / 800  # HUD text scales with the width like the 800x600 image used to be resized
+            self._renderers[size] = (SeparableResampler((24,32), (size[1],size[0]), kernel='spline'),
+                                     FloatColorizer((size[1],size[0])),
+                                     HudOverlay(origin=(round(30*scale), round(18*scale)), scale=.4*scale))
+        return self._renderers[size]
+
+    def _render(self, size:tuple = (800,600)):
+        """Render the raw temp data to a colored image of size (width, height). Filter if necessary"""
         # Can't apply colormap before ndimage, so reversed in first two options, even though it seems slower
+        width, height = size
         if self._interpolation_index==5:  # Scale via scipy only - slowest but seems higher quality
-            self._image = ndimage.zoom(self._raw_image,25)  # interpolate with scipy
-            self._image = cv2.applyColorMap(self._image, cmapy.cmap(self._colormap_list[self._colormap_index]))
+            image = ndimage.zoom(self._raw_image,(height/24,width/32))  # interpolate with scipy
+            image = cv2.applyColorMap(image, self._colormap)
         elif self._interpolation_index==6:  # Scale partially via scipy and partially via cv2 - mix of speed and quality
-            self._image = ndimage.zoom(self._raw_image,10)  # interpolate with scipy
-            self._image = cv2.applyColorMap(self._image, cmapy.cmap(self._colormap_list[self._colormap_index]))
-            self._image = cv2.resize(self._image, (800,600), interpolation=cv2.INTER_CUBIC)
-        else:
-            self._image = cv2.applyColorMap(self._raw_image, cmapy.cmap(self._colormap_list[self._colormap_index]))
-            self._image = cv2.resize(self._image, (800,600), interpolation=self._interpolation_list[self._interpolation_index])
-        self._image = cv2.flip(self._image, 1)
-        if self.filter_image:
-            self._image=cv2.bilateralFilter(self._image,15,80,80)
-
-    def _add_image_text(self):
-        """Set image text content"""
-        if self.use_f:
-            temp_min=self._c_to_f(self._temp_min)
-            temp_max=self._c_to_f(self._temp_max)
-            text = f'Tmin={temp_min:+.1f}F - Tmax={temp_max:+.1f}F - FPS={1/(time.time() - self._t0):.1f} - Interpolation: {self._interpolation_list_name[self._interpolation_index]} - Colormap: {self._colormap_list[self._colormap_index]} - Filtered: {self.filter_image}'
+            image = ndimage.zoom(self._raw_image,10)  # interpolate with scipy
+            image = cv2.applyColorMap(image, self._colormap)
+            image = cv2.resize(image, size, interpolation=cv2.INTER_CUBIC)
+        elif self._interpolation_index==7:  # Upscale float temperatures with precomputed spline matrices and colour them without quantizing
+            resampler, colorizer, _ = self.register_output_size(size)
+            lut = colormap_table(self._colormap_list[self._colormap_index], 1024)
+            temps = self._display_temps
+            if self.filter_image and self._prefilter is None:  # Smooth the 768 sensor pixels, not every output pixel
+                if self._grid_smooth is None:
+                    self._grid_smooth = GridPrefilter('smooth')
+                temps = self._grid_smooth(temps).reshape(-1)
+                temps[np.isnan(self._display_temps)] = np.nan  # Unread pixels stay unread for the resampler
+            image = colorizer(resampler(temps),self._temp_min,self._temp_max,lut)
         else:
-            text = f'Tmin={self._temp_min:+.1f}C - Tmax={self._temp_max:+.1f}C - FPS={1/(time.time() - self._t0):.1f} - Interpolation: {self._interpolation_list_name[self._interpolation_index]} - Colormap: {self._colormap_list[self._colormap_index]} - Filtered: {self.filter_image}'
-        cv2.putText(self._image, text, (30, 18), cv2.FONT_HERSHEY_SIMPLEX, .4, (255, 255, 255), 1)
-        self._t0 = time.time()  # Update time to this pull
+            image = cv2.applyColorMap(self._raw_image, self._colormap)
+            image = cv2.resize(image, size, interpolation=self._interpolation_list[self._interpolation_index])
+        image = cv2.flip(image, 1)
+        if self.filter_image and self._prefilter is None and self._interpolation_index!=7:
+            image=cv2.bilateralFilter(image,15,80,80)
+        return image
+
+    def _process_raw_image(self):
+        """Process the raw temp data to the 800x600 colored image"""
+        self._image = self._render((800,600))
+
+    def _add_image_text(self, image=None, size:tuple = (800,600)):
+        """Set image text content on image, the 800x600 image by default"""
+        if image is None:
+            image = self._image
+        if self._hud_seq != self._frame_seq:  # Format once per frame, whichever size is drawn first
+            self._frame_times.append(time.monotonic())
+            times = list(self._frame_times)
+            if len(times) > 1:  # Mean over the window; keeps the last value right after a rate change
+                self._fps = (len(times) - 1) / max(times[-1] - times[0], 1e-6)
+            if self.use_f:
+                temp_min=self._c_to_f(self._temp_min)
+                temp_max=self._c_to_f(self._temp_max)
+                numbers = f'Tmin={temp_min:+.1f}F - Tmax={temp_max:+.1f}F - FPS={self._fps:.1f} - '
+            else:
+                numbers = f'Tmin={self._temp_min:+.1f}C - Tmax={self._temp_max:+.1f}C - FPS={self._fps:.1f} - '
+            settings = f'Interpolation: {self._interpolation_list_name[self._interpolation_index]} - Colormap: {self._colormap_list[self._colormap_index]} - Filtered: {self.filter_image and self.filter_mode}'
+            self._hud_text = (numbers, settings)
+            self._hud_seq = self._frame_seq
+        self.register_output_size(size)[2].draw(image, *self._hud_text)  # Settings text is only rasterized when it changes
 
         # For a brief period after saving, display saved notification
         if self._file_saved_notification_start is not None and (time.monotonic()-self._file_saved_notification_start)<1:
-            cv2.putText(self._image, 'Snapshot Saved!', (300,300),cv2.FONT_HERSHEY_SIMPLEX, .8, (255, 255, 255), 2)
+            scale = size[0] / 800
+            draw_text(image, 'Snapshot Saved!', (round(300*scale),round(300*scale)), .8*scale, max(round(2*scale),1))
+
+    def _sized_image(self, size:tuple):
+        """Return the current frame rendered straight from the 24x32 data at size, cached until the next frame"""
+        cached = self._sized_images.get(size)
+        if cached is not None and cached[0] == self._frame_seq:
+            return cached[1]
+        image = self._render(size)
+        self._add_image_text(image, size)
+        self._sized_images[size] = (self._frame_seq, image)
+        return image
 
     def add_customized_text(self,text):
         """Add custom text to the center of the image, used mostly to notify user that server is off."""
@@ -214,6 +424,7 @@ class pithermalcam:
             self._colormap_index-=1
             if self._colormap_index<0:
                 self._colormap_index=len(self._colormap_list)-1
+        self._colormap = colormap_lut(self._colormap_list[self._colormap_index])
 
     def change_interpolation(self, forward:bool = True):
         """Cycle interpolation. Forward by default, backwards if param set to false."""
@@ -226,25 +437,31 @@ class pithermalcam:
             if self._interpolation_index<0:
                 self._interpolation_index=len(self._interpolation_list)-1
 
-    def update_image_frame(self):
-        """Pull raw temperature data, process it to an image, and update image text"""
+    def update_image_frame(self, size:tuple = None):
+        """Pull raw temperature data, process it to an image, and update image text. Renders at size (width, height) if given."""
         self._pull_raw_image()
-        self._process_raw_image()
-        self._add_image_text()
-        self._current_frame_processed=True
+        if size is not None and tuple(size) != (800,600):
+            return self._sized_image(tuple(size))
+        if not self._current_frame_processed:  # Nothing new to process if no new frame was pulled
+            self._process_raw_image()
+            self._add_image_text()
+            self._current_frame_processed=True
         return self._image
 
     def update_raw_image_only(self):
         """Update only raw data without any further image processing or text updating"""
-        self._pull_raw_image
+        self._pull_raw_image()
 
     def get_current_raw_image_frame(self):
-        """Return the current raw image"""
-        self._pull_raw_image
+        """Return the current raw image, first taking the newest frame if reading on a background thread"""
+        if self._ring is not None:
+            self._pull_raw_image()
         return self._raw_image
 
-    def get_current_image_frame(self):
-        """Get the processed image"""
+    def get_current_image_frame(self, size:tuple = None):
+        """Get the processed image, at size (width, height) if given"""
+        if size is not None and tuple(size) != (800,600):
+            return self._sized_image(tuple(size))
         # If the current raw image hasn't been procssed, process and return it
         if not self._current_frame_processed:
             self._process_raw_image()
@@ -252,6 +469,24 @@ class pithermalcam:
             self._current_frame_processed=True
         return self._image
 
+    def update_bgra_frame(self, size:tuple = (800,600), transparent_c:float = 30.0, opaque_c:float = 40.0):
+        """Pull raw temperature data and return the frame as premultiplied BGRA, see get_current_bgra_frame"""
+        self._pull_raw_image()
+        return self.get_current_bgra_frame(size, transparent_c, opaque_c)
+
+    def get_current_bgra_frame(self, size:tuple = (800,600), transparent_c:float = 30.0, opaque_c:float = 40.0):
+        """
+        Get the processed image at size as premultiplied BGRA, transparent where the scene is at or below
+        transparent_c and opaque at or above opaque_c. Cached per frame; don't modify the returned array.
+        """
+        key = (tuple(size), transparent_c, opaque_c)
+        cached = self._bgra_images.get(key)
+        if cached is not None and cached[0] == self._frame_seq:
+            return cached[1]
+        bgra = premultiplied_bgra(self.get_current_image_frame(size), self._temps, transparent_c, opaque_c)
+        self._bgra_images[key] = (self._frame_seq, bgra)
+        return bgra
+
     def save_image(self):
         """Save the current frame as a snapshot to the output folder."""
         fname = self.output_folder + 'pic_' + dt.datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + '.jpg'
@@ -259,11 +494,32 @@ class pithermalcam:
         self._file_saved_notification_start = time.monotonic()
         print('Thermal Image ', fname)
 
-    def _temps_to_rescaled_uints(self,f,Tmin,Tmax):
+    def record_raw_frames(self, count:int, fname:str = None):
+        """
+        Record count raw subpages without converting them to temperatures, so slow boards can log at the
+        full refresh rate. Saves to the output folder and returns the file name; convert the file later
+        with mlx90640_fast.convert_raw_log and the cached calibration file.
+        """
+        if not self.fast_calc or self.threaded:
+            raise ValueError("Raw recording requires fast_calc and no acquisition thread")
+        log = RawFrameLog(count)
+        while True:
+            try:
+                if not log.capture(self.mlx):
+                    break
+            except (OSError, RuntimeError):
+                logger.info(traceback.format_exc())
+        if fname is None:
+            fname = self.output_folder + 'raw_' + dt.datetime.now().strftime('%Y-%m-%d_%H-%M-%S') + '.npz'
+        log.save(fname)
+        print('Raw Frames ', fname)
+        return fname
+
+    def _temps_to_rescaled_uints(self,f,Tmin,Tmax,shape:tuple = (24,32)):
         """Function to convert temperatures to pixels on image"""
         f=np.nan_to_num(f)
-        norm = np.uint8((f - Tmin)*255/(Tmax-Tmin))
-        norm.shape = (24,32)
+        norm = np.uint8(np.clip((f - Tmin)*255/(Tmax-Tmin), 0, 255))  # Clip so out of range temps don't wrap around
+        norm.shape = shape
         return norm
 
     def display_camera_onscreen(self):
@@ -273,7 +529,7 @@ class pithermalcam:
                 self.display_next_frame_onscreen()
             # Catch a common I2C Error. If you get this too often consider checking/adjusting your I2C Baudrate
             except RuntimeError as e:
-                if e.message == 'Too many retries':
+                if str(e) == 'Too many retries':
                     print("Too many retries error caught, potential I2C baudrate issue: continuing...")
                     continue
                 raise
@@ -1,22 +1,23 @@
-from flask import Flask, Response, render_template
+from flask import Flask, render_template, request
 import threading
 import time
 import io
 import cv2
 from picamera2 import Picamera2
-from pithermalcam import pithermalcam
+from pithermcam_fixed_temps import pithermalcam
+from frame_ring import FrameSlot, newest_frames
+from stream_hub import VariantHubs
+from stream_server import run
 
 app = Flask(__name__)
 
 # Global variables for HD and Thermal camera frames
-hd_output_frame = None
-thermal_output_frame = None
-hd_lock = threading.Lock()
-thermal_lock = threading.Lock()
+frames_ready = threading.Condition()  # Shared by both slots so the renderer can wait for either camera
+hd_frames = FrameSlot(frames_ready)
+thermal_frames = FrameSlot(frames_ready)
 
 # HD Camera Thread and Functionality
 def capture_hd_frames():
-    global hd_output_frame, hd_lock
     picam2_hd = Picamera2()
     config_hd = picam2_hd.create_preview_configuration(main={"size": (640, 480)})
     picam2_hd.configure(config_hd)
@@ -25,54 +26,55 @@ def capture_hd_frames():
     while True:
         image_hd = picam2_hd.capture_array()
         image_hd = cv2.cvtColor(image_hd, cv2.COLOR_BGR2RGB)
-        with hd_lock:
-            hd_output_frame = image_hd.copy()
+        hd_frames.publish(image_hd)
 
 # Thermal Camera Thread and Functionality
 def pull_images():
-    global thermal_output_frame, thermal_lock
-    thermcam = pithermalcam(output_folder='/home/pi/pithermalcam/saved_snapshots/')
+    thermcam = pithermalcam(output_folder='/home/pi/pithermalcam/saved_snapshots/', fixed_range=None,  # Colours auto-ranged per frame, as in sbs_2
+                            adaptive_refresh=True)
     time.sleep(0.1)
 
     while True:
-        current_frame = thermcam.update_image_frame()
+        thermcam.set_client_count(stream_variants.clients)  # The sensor slows down while nobody is watching
+        current_frame = thermcam.update_image_frame(size=(320, 240))  # Rendered straight at the display size
         if current_frame is not None:
-            with thermal_lock:
-                thermal_output_frame = current_frame.copy()
+            thermal_frames.publish(current_frame)
 
 # Flask Routes
 @app.route("/")
 def index():
     return render_template("index.html")
 
-def generate():
-    global hd_output_frame, thermal_output_frame, hd_lock, thermal_lock
-    while True:
-        with hd_lock:
-            hd_frame = hd_output_frame.copy() if hd_output_frame is not None else None
-        with thermal_lock:
-            thermal_frame = thermal_output_frame.copy() if thermal_output_frame is not None else None
-        
-        if hd_frame is None or thermal_frame is None:
-            continue
-        
-        # Resize frames if needed to display side by side
-        hd_frame = cv2.resize(hd_frame, (320, 240))
-        thermal_frame = cv2.resize(thermal_frame, (320, 240))
-        
-        # Combine frames horizontally
-        combined_frame = cv2.hconcat([hd_frame, thermal_frame])
+def frame_renderer(size:tuple = (640, 240), layout:str = 'sbs'):
+    """Return a render_frame for one stream variant, drawing layout at size (width, height)"""
+    seen = (0, 0)  # Sequence numbers of the HD and thermal frames last rendered
 
-        # Encode combined frame
-        (flag, encoded_image) = cv2.imencode(".jpg", combined_frame)
-        if not flag:
-            continue
+    def render_frame():
+        """Render the newest frames, or return None if neither camera has a new frame within a second"""
+        nonlocal seen
+        sequences, frames = newest_frames((hd_frames, thermal_frames), seen, timeout=1.0)
+        stale = layout == 'hd' and sequences[0] == seen[0] or layout == 'thermal' and sequences[1] == seen[1]
+        seen = sequences
+        if stale or frames is None:  # Stale when only the other camera has a new frame
+            return None
+        hd_frame, thermal_frame = frames
+        if layout == 'hd':
+            return cv2.resize(hd_frame, size)
+        if layout == 'thermal':
+            return cv2.resize(thermal_frame, size)
         
-        yield (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + bytearray(encoded_image) + b'\r\n')
+        # Resize each frame to half the width to display side by side
+        half = (size[0] // 2, size[1])
+        return cv2.hconcat([cv2.resize(hd_frame, half), cv2.resize(thermal_frame, (size[0] - half[0], size[1]))])
+    return render_frame
+
+# Variants for ?w=&h=&q=&layout=; the default is the two 320x240 frames side by side
+stream_variants = VariantHubs(frame_renderer, (640, 240), layouts=('sbs', 'hd', 'thermal'))
 
 @app.route("/video_feed")
 def video_feed():
-    return Response(generate(), mimetype="multipart/x-mixed-replace; boundary=frame")
+    # ?w=&h=&q=&layout= pick a variant; each is rendered and encoded once for all of its clients
+    return stream_variants.response(request.args)
 
 if __name__ == '__main__':
     # Start HD camera thread
@@ -85,5 +87,5 @@ if __name__ == '__main__':
     thermal_thread.daemon = True
     thermal_thread.start()
 
-    # Run Flask app
-    app.run(host='0.0.0.0', port=8050, debug=True, threaded=True, use_reloader=False)
+    # Run Flask app on port 8050 (--async for the asyncio server)
+    run(app, {'/video_feed': stream_variants}, port=8050)
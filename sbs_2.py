@@ -2,43 +2,40 @@ from flask import Flask, Response, render_template
 import threading
 import time
 import io
-import cv2
 from picamera2 import Picamera2
 from pithermalcam import pithermalcam
+from frame_ring import FrameSlot
+from stream_hub import BroadcastHub, MJPEGProducer, MJPEG_MIMETYPE
+from stream_server import run
 
 app = Flask(__name__)
 
 # Global variables for HD and Thermal camera frames
-hd_output_frame = None
-thermal_output_frame = None
-hd_lock = threading.Lock()
-thermal_lock = threading.Lock()
+hd_frames = FrameSlot()
+thermal_frames = FrameSlot()
+hd_hub = BroadcastHub()  # Each feed is encoded once and shared by all of its clients
+thermal_hub = BroadcastHub()
 
 # HD Camera Thread and Functionality
 def capture_hd_frames():
-    global hd_output_frame, hd_lock
     picam2_hd = Picamera2()
-    config_hd = picam2_hd.create_preview_configuration(main={"size": (640, 480)})
+    # Planar YUV420 is encoded to JPEG as is, without a per-frame RGB conversion
+    config_hd = picam2_hd.create_preview_configuration(main={"size": (640, 480), "format": "YUV420"})
     picam2_hd.configure(config_hd)
     picam2_hd.start()
 
     while True:
-        image_hd = picam2_hd.capture_array()
-        image_hd = cv2.cvtColor(image_hd, cv2.COLOR_BGR2RGB)
-        with hd_lock:
-            hd_output_frame = image_hd.copy()
+        hd_frames.publish(picam2_hd.capture_array())
 
 # Thermal Camera Thread and Functionality
 def pull_images():
-    global thermal_output_frame, thermal_lock
     thermcam = pithermalcam(output_folder='/home/pi/pithermalcam/saved_snapshots/')
     time.sleep(0.1)
 
     while True:
         current_frame = thermcam.update_image_frame()
         if current_frame is not None:
-            with thermal_lock:
-                thermal_output_frame = current_frame.copy()
+            thermal_frames.publish(current_frame.copy())
 
 # Flask Routes
 @app.route("/")
@@ -46,45 +43,24 @@ def index():
     return render_template("both.html")
 # can be called index.html but there already is one, so this test is being named both.html 
 
-def generate_hd():
-    global hd_output_frame, hd_lock
-    while True:
-        with hd_lock:
-            hd_frame = hd_output_frame.copy() if hd_output_frame is not None else None
-        
-        if hd_frame is None:
-            continue
-        
-        # Encode HD frame
-        (flag, encoded_image) = cv2.imencode(".jpg", hd_frame)
-        if not flag:
-            continue
-        
-        yield (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + bytearray(encoded_image) + b'\r\n')
-
-def generate_thermal():
-    global thermal_output_frame, thermal_lock
-    while True:
-        with thermal_lock:
-            thermal_frame = thermal_output_frame.copy() if thermal_output_frame is not None else None
-        
-        if thermal_frame is None:
-            continue
-        
-        # Encode Thermal frame
-        (flag, encoded_image) = cv2.imencode(".jpg", thermal_frame)
-        if not flag:
-            continue
-        
-        yield (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + bytearray(encoded_image) + b'\r\n')
+def next_frame(slot):
+    """Return a renderer that waits up to a second for a frame from slot newer than the last one rendered"""
+    seen = 0
+    def render():
+        nonlocal seen
+        if not slot.wait_for(seen, timeout=1.0):
+            return None
+        seen, frame = slot.latest()
+        return frame
+    return render
 
 @app.route("/video_feed_hd")
 def video_feed_hd():
-    return Response(generate_hd(), mimetype="multipart/x-mixed-replace; boundary=frame")
+    return Response(hd_hub.stream(), mimetype=MJPEG_MIMETYPE)
 
 @app.route("/video_feed_thermal")
 def video_feed_thermal():
-    return Response(generate_thermal(), mimetype="multipart/x-mixed-replace; boundary=frame")
+    return Response(thermal_hub.stream(), mimetype=MJPEG_MIMETYPE)
 
 if __name__ == '__main__':
     # Start HD camera thread
@@ -97,5 +73,9 @@ if __name__ == '__main__':
     thermal_thread.daemon = True
     thermal_thread.start()
 
-    # Run Flask app
-    app.run(host='0.0.0.0', port=8010, debug=True, threaded=True, use_reloader=False)
+    # Encode each new frame once for all clients of its feed
+    MJPEGProducer(hd_hub, next_frame(hd_frames), slices=4, yuv420=True).start()  # One slice per Pi core
+    MJPEGProducer(thermal_hub, next_frame(thermal_frames)).start()
+
+    # Run Flask app; with --async both feeds and both.html are served from one event loop
+    run(app, {'/video_feed_hd': hd_hub, '/video_feed_thermal': thermal_hub}, port=8010, page='both.html')
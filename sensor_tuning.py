@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/python3
+##################################
+# Runtime tuning of the MLX90640 refresh rate and I2C bus frequency
+##################################
+import os
+import json
+import time
+import threading
+import logging
+from adafruit_mlx90640 import RefreshRate
+
+logger = logging.getLogger(__name__)
+
+I2C_FREQUENCIES = [100000, 400000, 600000, 800000, 1000000]
+
+
+def refresh_rate_hz(rate:int):
+    """Subpage rate in Hz for a RefreshRate value"""
+    return 0.5 * 2 ** rate
+
+
+class RefreshRateController:
+    """
+    Pick the MLX90640 refresh rate from measured demand, achieved frame rate and I2C error rate.
+
+    The reading thread calls record_read() after every sensor read and the consumer calls
+    record_consumed() whenever it takes a frame. Every window reads the rate is stepped down if the
+    sensor can't be kept up with, I2C errors are frequent, consumers take fewer than half the frames
+    or no client is connected (set_clients). It is stepped up when everything produced is consumed,
+    the nominal rate is reached and there were no errors. After a step down for errors or read time,
+    stepping up is held off for hold_windows windows to avoid oscillating. Client changes don't wait for
+    a window: when the last viewer leaves the rate drops to min_rate at the next read, and when one
+    connects again the rate in use before that is restored at the next read.
+
+    Rate changes are written to the sensor from the thread calling record_read, then passed to each
+    callable in listeners as listener(old_hz, new_hz, reason).
+    """
+
+    def __init__(self, mlx, rate:int = RefreshRate.REFRESH_8_HZ, min_rate:int = RefreshRate.REFRESH_2_HZ,
+                 max_rate:int = RefreshRate.REFRESH_32_HZ, frame_subpages:int = 2, window:int = 16,
+                 max_error_rate:float = 0.1, hold_windows:int = 8):
+        self.mlx = mlx
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.frame_subpages = frame_subpages  # Subpages per read: 2 for getFrame, 1 in subpage mode
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.hold_windows = hold_windows
+        self.clients = None  # Unknown until set_clients is called
+        self.listeners = []
+        self._hold = 0
+        self._active_rate = rate  # Rate to restore when a client connects again
+        self._pending = None  # (rate, reason) to switch to at the next read after a client change
+        self._lock = threading.Lock()
+        self._reset_window()
+
+    def _reset_window(self):
+        self._reads = 0
+        self._errors = 0
+        self._consumed = 0
+        self._window_start = time.monotonic()
+
+    def record_read(self, ok:bool = True):
+        """Count one sensor read, failed if ok is False, and re-evaluate at the end of each window"""
+        with self._lock:
+            self._reads += 1
+            if not ok:
+                self._errors += 1
+            if self._pending is not None:
+                (new_rate, reason), self._pending = self._pending, None
+            elif self._reads < self.window:
+                return
+            else:
+                new_rate, reason = self._evaluate()
+            self._reset_window()
+        if new_rate != self.rate:
+            self._set_rate(new_rate, reason)
+
+    def record_consumed(self):
+        """Count one frame taken by a consumer"""
+        with self._lock:
+            self._consumed += 1
+
+    def set_clients(self, clients:int):
+        """Set the number of connected viewers; the rate follows at the next read when it becomes or stops being 0"""
+        with self._lock:
+            if clients == 0 and self.clients != 0:
+                self._active_rate = self.rate
+                self._pending = (self.min_rate, 'no clients')
+            elif clients and self.clients == 0:
+                self._pending = (self._active_rate, 'clients connected')
+            self.clients = clients
+
+    def _evaluate(self):
+        """Return the rate to use for the next window and why"""
+        elapsed = max(time.monotonic() - self._window_start, 1e-6)
+        good_reads = self._reads - self._errors
+        produced_fps = good_reads / elapsed
+        consumed_fps = self._consumed / elapsed
+        nominal_fps = refresh_rate_hz(self.rate) / self.frame_subpages
+        self._hold = max(self._hold - 1, 0)
+
+        if self.clients == 0:
+            return self.min_rate, 'no clients'
+        if self._errors / self._reads > self.max_error_rate:
+            self._hold = self.hold_windows
+            return max(self.rate - 1, self.min_rate), 'i2c errors'
+        if produced_fps < 0.8 * nominal_fps:
+            self._hold = self.hold_windows
+            return max(self.rate - 1, self.min_rate), 'read time'
+        if consumed_fps < 0.5 * produced_fps:
+            return max(self.rate - 1, self.min_rate), 'low demand'
+        if consumed_fps >= 0.9 * produced_fps and self._errors == 0 and not self._hold:
+            return min(self.rate + 1, self.max_rate), 'headroom'
+        return self.rate, None
+
+    def _set_rate(self, rate:int, reason:str):
+        """Write the new rate to the sensor and notify listeners"""
+        old_rate = self.rate
+        try:
+            self.mlx.refresh_rate = rate
+        except (OSError, RuntimeError):
+            logger.warning("Could not change refresh rate to %s Hz", refresh_rate_hz(rate))
+            return
+        self.rate = rate
+        logger.info("Refresh rate %s Hz -> %s Hz (%s)", refresh_rate_hz(old_rate), refresh_rate_hz(rate), reason)
+        for listener in self.listeners:
+            listener(refresh_rate_hz(old_rate), refresh_rate_hz(rate), reason)
+
+
+class I2CFrequencyTuner:
+    """
+    Find the highest I2C frequency whose error rate stays under max_error_rate, and back off at runtime.
+
+    set_frequency is a callable that rebuilds the bus at the given frequency and returns the frequency the
+    bus actually runs at, or None if that can't be told. tune() runs at startup:
+    it checks the saved frequency with one window of probe reads and falls back to an upward search
+    when there is none or it fails. At runtime the reading thread calls record() after every read;
+    after sustain windows in a row over max_error_rate the frequency is stepped down one level. The
+    chosen frequency is saved to state_file.
+
+    On a Raspberry Pi the kernel driver sets the real bus speed (dtparam=i2c_arm_baudrate in
+    /boot/config.txt) and busio ignores the frequency argument. Whenever the bus doesn't run at the
+    frequency asked for, tuning is disabled with a warning, since every probe would measure the same
+    fixed rate, and nothing is saved.
+    """
+
+    def __init__(self, set_frequency, frequencies:list = I2C_FREQUENCIES, default:int = 400000, window:int = 32,
+                 max_error_rate:float = 0.02, sustain:int = 2, state_file:str = None):
+        self.set_frequency = set_frequency
+        self.frequencies = sorted(frequencies)
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.sustain = sustain
+        self.state_file = state_file
+        self.saved_frequency = self._load()
+        self.frequency = self.saved_frequency or default
+        self.enabled = True  # False once the bus turned out to ignore the frequency
+        self._reads = 0
+        self._errors = 0
+        self._bad_windows = 0
+
+    def _load(self):
+        """Return the saved frequency, or None"""
+        if self.state_file is None:
+            return None
+        try:
+            with open(self.state_file) as f:
+                frequency = json.load(f)['frequency']
+        except (OSError, ValueError, KeyError):
+            return None
+        return frequency if frequency in self.frequencies else None
+
+    def _save(self):
+        if self.state_file is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.state_file) or '.', exist_ok=True)
+            with open(self.state_file, 'w') as f:
+                json.dump({'frequency': self.frequency}, f)
+        except OSError:
+            logger.warning("Could not save I2C frequency to %s", self.state_file)
+
+    def _apply(self, frequency:int):
+        """Switch to frequency. Returns False, and disables tuning, if the bus doesn't run at it."""
+        applied = self.set_frequency(frequency)
+        if applied != frequency:
+            logger.warning("I2C bus runs at %s instead of the requested %d Hz; frequency tuning disabled. "
+                           "Set dtparam=i2c_arm_baudrate in /boot/config.txt instead.",
+                           'an unknown rate' if applied is None else f'{applied} Hz', frequency)
+            self.enabled = False
+            self.frequency = applied
+            return False
+        self.frequency = frequency
+        return True
+
+    def error_rate(self, probe, frequency:int):
+        """
+        Switch to frequency and return the fraction of window probe() calls that raised OSError, or None
+        if the bus doesn't run at frequency
+        """
+        if not self._apply(frequency):
+            return None
+        errors = 0
+        for _ in range(self.window):
+            try:
+                probe()
+            except OSError:
+                errors += 1
+        return errors / self.window
+
+    def tune(self, probe):
+        """
+        Pick and save the startup frequency. probe is a callable doing one representative I2C read.
+        Returns the frequency in use, None if it is unknown.
+        """
+        if self.saved_frequency is not None:
+            rate = self.error_rate(probe, self.saved_frequency)
+            if rate is None or rate <= self.max_error_rate:
+                return self.frequency
+
+        best = self.frequencies[0]
+        for frequency in self.frequencies:
+            rate = self.error_rate(probe, frequency)
+            if rate is None:
+                return self.frequency
+            if rate > self.max_error_rate:
+                break
+            best = frequency
+        if not self._apply(best):
+            return self.frequency
+        self._save()
+        logger.info("I2C frequency tuned to %d Hz", best)
+        return best
+
+    def record(self, ok:bool = True):
+        """Count one runtime read and step the frequency down after sustained errors"""
+        if not self.enabled:
+            return
+        self._reads += 1
+        if not ok:
+            self._errors += 1
+        if self._reads < self.window:
+            return
+        if self._errors / self._reads > self.max_error_rate:
+            self._bad_windows += 1
+        else:
+            self._bad_windows = 0
+        self._reads = 0
+        self._errors = 0
+
+        index = self.frequencies.index(self.frequency) if self.frequency in self.frequencies else 0
+        if self._bad_windows >= self.sustain and index > 0:
+            self._bad_windows = 0
+            logger.warning("Sustained I2C errors at %d Hz; backing off", self.frequency)
+            if self._apply(self.frequencies[index - 1]):
+                self._save()
+
+    def record_error(self, error:Exception):
+        """
+        Count one failed runtime read. Bus errors (OSError) and the driver giving up on a subpage that
+        kept changing mid-read ("Too many retries") count against the frequency; bad frame data doesn't.
+        """
+        self.record(ok=not (isinstance(error, OSError) or str(error) == "Too many retries"))
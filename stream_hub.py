@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/python3
+##################################
+# Encode-once MJPEG broadcasting to any number of /video_feed clients
+##################################
+import collections
+import threading
+import time
+from jpeg_encoder import JpegEncoder
+
+MJPEG_MIMETYPE = "multipart/x-mixed-replace; boundary=frame"
+
+
+def mjpeg_part(jpeg:bytes):
+    """Wrap encoded JPEG bytes as one part of a multipart/x-mixed-replace stream"""
+    return b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n'
+
+
+class Subscriber:
+    """
+    One client's bounded queue of stream parts.
+
+    When the queue is full the oldest part is dropped, so a slow client skips frames and always
+    catches up to the newest one instead of falling further behind. dropped counts the skipped parts.
+    """
+
+    def __init__(self, hub, max_queue:int = 2):
+        self._hub = hub
+        self._queue = collections.deque(maxlen=max_queue)
+        self.dropped = 0
+        self.closed = False
+
+    def _put(self, part:bytes):
+        """Queue a part; called by the hub with its lock held"""
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1
+        self._queue.append(part)
+
+    def get(self, timeout:float = None):
+        """Return the oldest queued part, waiting for one if needed. Returns None on timeout or close."""
+        with self._hub._ready:
+            if not self._hub._ready.wait_for(lambda: self._queue or self.closed, timeout):
+                return None
+            return self._queue.popleft() if self._queue else None
+
+
+class BroadcastHub:
+    """
+    Fan out each published stream part to every subscribed client.
+
+    A producer encodes every new frame once and publishes the resulting bytes; all clients receive the
+    same immutable bytes object, so the render and encode cost no longer scales with the number of
+    viewers. Each client has its own bounded Subscriber queue. Servers that do their own fan-out, like
+    stream_server.AsyncStreamServer, can register a listener instead of one Subscriber per client.
+    """
+
+    def __init__(self, max_queue:int = 2):
+        self.max_queue = max_queue
+        self.sequence = 0  # Number of parts published so far
+        self._subscribers = []
+        self._listeners = []
+        self._ready = threading.Condition()
+
+    @property
+    def clients(self):
+        return len(self._subscribers) + len(self._listeners)
+
+    def subscribe(self, max_queue:int = None):
+        """Register a new client and return its Subscriber"""
+        subscriber = Subscriber(self, self.max_queue if max_queue is None else max_queue)
+        with self._ready:
+            self._subscribers.append(subscriber)
+            self._ready.notify_all()  # Wakes a producer waiting for its first client
+        return subscriber
+
+    def unsubscribe(self, subscriber:Subscriber):
+        """Remove a client; its pending get() returns None"""
+        with self._ready:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+            subscriber.closed = True
+            self._ready.notify_all()
+
+    def add_listener(self, callback):
+        """Call callback(part) on the producer's thread for every published part. Counts as a client."""
+        with self._ready:
+            self._listeners.append(callback)
+            self._ready.notify_all()
+
+    def remove_listener(self, callback):
+        with self._ready:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+
+    def publish(self, part:bytes):
+        """Queue one part for every client and wake them"""
+        with self._ready:
+            self.sequence += 1
+            for subscriber in self._subscribers:
+                subscriber._put(part)
+            listeners = list(self._listeners)
+            self._ready.notify_all()
+        for callback in listeners:
+            callback(part)
+
+    def wait_for_clients(self, timeout:float = None):
+        """Block until at least one client is subscribed. Returns False on timeout."""
+        with self._ready:
+            return self._ready.wait_for(lambda: self._subscribers or self._listeners, timeout)
+
+    def stream(self, timeout:float = 1.0, subscriber:Subscriber = None):
+        """
+        Generator of parts for one client, for Flask's Response. Unsubscribes when the client disconnects.
+        Pass a subscriber from subscribe() to count the client before the response starts being iterated.
+        """
+        if subscriber is None:
+            subscriber = self.subscribe()
+        try:
+            while True:
+                part = subscriber.get(timeout)
+                if part is not None:
+                    yield part
+        finally:
+            self.unsubscribe(subscriber)
+
+
+class MJPEGProducer:
+    """
+    Thread that renders, JPEG-encodes and publishes frames to a BroadcastHub.
+
+    render is called repeatedly and returns the next BGR frame, or None when there is nothing new to
+    send. With yuv420 set it returns packed YUV420 arrays instead, such as Picamera2 captures with
+    format "YUV420". Nothing is rendered or encoded while no client is connected. quality, subsampling
+    and slices configure the JpegEncoder.
+    """
+
+    def __init__(self, hub:BroadcastHub, render, quality:int = 95, idle_sleep:float = 0.005, subsampling:str = '420',
+                 slices:int = 1, yuv420:bool = False):
+        self.hub = hub
+        self.render = render
+        self.encoder = JpegEncoder(quality, subsampling, slices)
+        self._encode = self.encoder.encode_yuv420 if yuv420 else self.encoder.encode
+        self.idle_sleep = idle_sleep  # Seconds to wait after render returns None
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Let the thread exit after its current frame"""
+        self._stopped = True
+
+    def _run(self):
+        while not self._stopped:
+            if not self.hub.wait_for_clients(timeout=1.0):
+                continue
+            frame = self.render()
+            if frame is None:
+                time.sleep(self.idle_sleep)
+                continue
+            self.hub.publish(mjpeg_part(self._encode(frame)))
+
+
+class VariantsBusy(RuntimeError):
+    """A new variant was requested while every one of VariantHubs.maxsize variants has clients"""
+
+
+class VariantHubs:
+    """
+    BroadcastHubs for size, quality and layout variants of one stream, created when first requested.
+
+    make_render(size, layout) returns a render callable for MJPEGProducer that draws that layout at size
+    (width, height). Each variant gets its own hub and producer, so every (frame, size, quality, layout)
+    is rendered and encoded at most once however many clients share it. The variants form a small LRU
+    cache of at most maxsize: to make room for a new one, the least recently requested variant without
+    clients is evicted and its producer stopped. When all of them have clients, new variants are refused
+    with VariantsBusy while existing ones can still be joined.
+    """
+
+    def __init__(self, make_render, size:tuple = (640, 480), quality:int = 95, layouts:tuple = ('default',),
+                 maxsize:int = 6, max_size:tuple = (1920, 1080), subsampling:str = '420', slices:int = 1):
+        self.make_render = make_render
+        self.size = tuple(size)  # Default (width, height)
+        self.quality = quality
+        self.layouts = tuple(layouts)  # The first one is the default
+        self.maxsize = maxsize
+        self.max_size = tuple(max_size)
+        self.subsampling = subsampling  # Encoder settings shared by all variants
+        self.slices = slices
+        self._variants = collections.OrderedDict()  # (width, height, quality, layout) -> (hub, producer)
+        self._lock = threading.Lock()
+
+    @property
+    def clients(self):
+        """Clients connected to any variant"""
+        with self._lock:
+            return sum(hub.clients for hub, _ in self._variants.values())
+
+    def hub(self, size:tuple = None, quality:int = None, layout:str = None, subscribe:bool = False):
+        """
+        Return the hub of a variant, starting its producer if needed. With subscribe, return (hub, Subscriber)
+        instead, subscribed before another request can evict the variant. Raises VariantsBusy.
+        """
+        key = tuple(size or self.size) + (quality or self.quality, layout or self.layouts[0])
+        with self._lock:
+            if key in self._variants:
+                self._variants.move_to_end(key)
+            else:
+                self._evict()
+                if len(self._variants) >= self.maxsize:
+                    raise VariantsBusy(f"All {self.maxsize} stream variants are in use")
+                hub = BroadcastHub()
+                producer = MJPEGProducer(hub, self.make_render(key[:2], key[3]), key[2], subsampling=self.subsampling,
+                                         slices=self.slices)
+                self._variants[key] = (hub, producer.start())
+            hub = self._variants[key][0]
+            return (hub, hub.subscribe()) if subscribe else hub
+
+    def _evict(self):
+        """Evict the least recently requested variants without clients until there is room for one more"""
+        for key in [key for key, (hub, _) in self._variants.items() if not hub.clients]:
+            if len(self._variants) < self.maxsize:
+                break
+            self._variants.pop(key)[1].stop()
+
+    def from_query(self, args, subscribe:bool = False):
+        """
+        Return the hub for query arguments w, h, q and layout, e.g. Flask's request.args, or (hub, Subscriber)
+        with subscribe. A missing w or h keeps the default aspect ratio. Raises ValueError for invalid
+        values and VariantsBusy when there is no room for a new variant.
+        """
+        try:
+            width, height, quality = (int(args[name]) if args.get(name) else None for name in ('w', 'h', 'q'))
+        except ValueError:
+            raise ValueError("w, h and q must be integers")
+        if width and not height:
+            height = round(width * self.size[1] / self.size[0])
+        elif height and not width:
+            width = round(height * self.size[0] / self.size[1])
+        size = (width, height) if width else None
+        if size and not (16 <= width <= self.max_size[0] and 16 <= height <= self.max_size[1]):
+            raise ValueError(f"Size must be between 16x16 and {self.max_size[0]}x{self.max_size[1]}")
+        if quality is not None and not 1 <= quality <= 100:
+            raise ValueError("Quality must be between 1 and 100")
+        layout = args.get('layout') or None
+        if layout is not None and layout not in self.layouts:
+            raise ValueError(f"Unknown layout {layout}, expected one of {list(self.layouts)}")
+        return self.hub(size, quality, layout, subscribe)
+
+    def response(self, args):
+        """
+        Flask Response streaming the variant picked by query arguments args, a 400 for invalid ones or a
+        503 when all variants are busy
+        """
+        from flask import Response  # Only the Flask apps need it; stream_server serves variants itself
+        try:
+            hub, subscriber = self.from_query(args, subscribe=True)
+        except ValueError as e:
+            return Response(str(e), status=400)
+        except VariantsBusy as e:
+            return Response(str(e), status=503)
+        response = Response(hub.stream(subscriber=subscriber), mimetype=MJPEG_MIMETYPE)
+        response.call_on_close(lambda: hub.unsubscribe(subscriber))  # Even if the stream was never started
+        return response
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/python3
+##################################
+# asyncio HTTP server for MJPEG streams, an alternative to Flask's threaded development server
+##################################
+import asyncio
+import os
+import sys
+from urllib.parse import urlsplit, parse_qs
+from stream_hub import VariantHubs, VariantsBusy, MJPEG_MIMETYPE
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 503: 'Service Unavailable'}
+
+
+class _StreamClient:
+    """One streaming connection: only the newest undelivered part is kept"""
+
+    def __init__(self):
+        self.part = None
+        self.ready = asyncio.Event()
+        self.dropped = 0  # Parts replaced before they could be sent
+
+    def offer(self, part:bytes):
+        if self.part is not None:
+            self.dropped += 1
+        self.part = part
+        self.ready.set()
+
+
+class AsyncStreamServer:
+    """
+    Serve BroadcastHub streams and static pages from a single asyncio event loop.
+
+    Each connection is a coroutine holding at most one pending part, so hundreds of idle clients cost
+    little compared with one thread each. A client may cap its frame rate with ?fps=N (up to
+    max_fps). The socket buffer is kept to one frame: a part published while the previous one is still
+    being written replaces the pending part instead of queueing behind it, so slow clients drop frames
+    rather than buffering them.
+
+    streams maps paths to BroadcastHubs or VariantHubs, whose variants are picked with ?w=&h=&q=&layout=,
+    and pages maps paths to HTML files, e.g.
+    AsyncStreamServer({'/video_feed': hub}, {'/': 'templates/index.html'}, port=8050).serve_forever()
+    """
+
+    def __init__(self, streams:dict, pages:dict = None, host:str = '0.0.0.0', port:int = 8000, max_fps:float = 30.0):
+        self.streams = streams
+        self.pages = pages or {}
+        self.host = host
+        self.port = port
+        self.max_fps = max_fps
+        self._clients = {}  # Connections per hub while it has any
+        self._listeners = {}  # Listener registered with each of those hubs
+        self._loop = None
+
+    def serve_forever(self):
+        """Run the server on a new event loop until interrupted"""
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            request = (await asyncio.wait_for(reader.readline(), 10)).decode('latin-1').split()
+            while (await asyncio.wait_for(reader.readline(), 10)).strip():
+                pass  # Headers aren't needed
+            if len(request) != 3:
+                return await self._respond(writer, 400)
+            method, target = request[0], urlsplit(request[1])
+            if method != 'GET':
+                return await self._respond(writer, 405)
+            if target.path in self.pages:
+                with open(self.pages[target.path], 'rb') as page:
+                    return await self._respond(writer, 200, page.read(), 'text/html; charset=utf-8')
+            if target.path not in self.streams:
+                return await self._respond(writer, 404)
+            query = {name: values[0] for name, values in parse_qs(target.query).items()}
+            try:
+                fps = min(float(query.get('fps', self.max_fps)), self.max_fps)
+            except ValueError:
+                fps = 0
+            if not fps > 0:
+                return await self._respond(writer, 400, b'fps must be a positive number')
+            hub = self.streams[target.path]
+            if isinstance(hub, VariantHubs):
+                try:
+                    hub = hub.from_query(query)  # _stream joins it before yielding, so it can't be evicted first
+                except ValueError as e:
+                    return await self._respond(writer, 400, str(e).encode())
+                except VariantsBusy as e:
+                    return await self._respond(writer, 503, str(e).encode())
+            await self._stream(writer, hub, 1 / fps)
+        except (asyncio.TimeoutError, ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status:int, body:bytes = b'', content_type:str = 'text/plain'):
+        writer.write(f'HTTP/1.1 {status} {_REASONS[status]}\r\nContent-Type: {content_type}\r\n'
+                     f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode('latin-1') + body)
+        await writer.drain()
+
+    async def _stream(self, writer, hub, interval:float):
+        writer.write(f'HTTP/1.1 200 OK\r\nContent-Type: {MJPEG_MIMETYPE}\r\nCache-Control: no-cache\r\n'
+                     f'Connection: close\r\n\r\n'.encode('latin-1'))
+        writer.transport.set_write_buffer_limits(high=0)  # drain() waits until the socket has taken everything
+        client = _StreamClient()
+        self._join(hub, client)
+        try:
+            while True:
+                await client.ready.wait()
+                client.ready.clear()
+                part, client.part = client.part, None
+                sent = self._loop.time()
+                writer.write(part)
+                await writer.drain()  # Parts published meanwhile replace each other in client.part
+                await asyncio.sleep(interval - (self._loop.time() - sent))
+        finally:
+            self._leave(hub, client)
+
+    def _join(self, hub, client:_StreamClient):
+        self._clients.setdefault(hub, set()).add(client)
+        if hub not in self._listeners:  # The hub's producer only runs while a listener or subscriber exists
+            listener = lambda part: self._loop.call_soon_threadsafe(self._deliver, hub, part)
+            self._listeners[hub] = listener
+            hub.add_listener(listener)
+
+    def _leave(self, hub, client:_StreamClient):
+        clients = self._clients[hub]
+        clients.discard(client)
+        if not clients:
+            del self._clients[hub]
+            hub.remove_listener(self._listeners.pop(hub))
+
+    def _deliver(self, hub, part:bytes):
+        for client in self._clients.get(hub, ()):
+            client.offer(part)
+
+
+def template_page(app, name:str = 'index.html'):
+    """Path of a Flask app's template, to serve as a static page"""
+    return os.path.join(app.root_path, app.template_folder, name)
+
+
+def run(app, streams:dict, port:int, page:str = 'index.html'):
+    """
+    Serve a Flask app's streams on port. With --async on the command line they are served by an
+    AsyncStreamServer, along with the app's template page at / unless page is None; otherwise the app
+    runs on Flask's threaded development server.
+    """
+    if '--async' in sys.argv:
+        pages = {'/': template_page(app, page)} if page else None
+        AsyncStreamServer(streams, pages, port=port).serve_forever()
+    else:
+        app.run(host='0.0.0.0', port=port, debug=True, threaded=True, use_reloader=False)
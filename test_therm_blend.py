@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/python3
+##################################
+# Checks that the blend modes of therm_blend agree; run with pytest
+##################################
+import numpy as np
+import cv2
+from therm_blend import ThresholdMask, HotRegions, FusionBlender
+
+
+def _blend_both(temps, size:tuple = (640, 480)):
+    """Return the per_pixel and regions blends of the same random images for a 24x32 temperature frame"""
+    rng = np.random.default_rng(0)
+    base = rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    overlay = rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    mask, regions = ThresholdMask(size), HotRegions(size)
+    mask.update(temps)
+    regions.update(temps)
+    results = []
+    for mode in ('per_pixel', 'regions'):
+        blender = FusionBlender(size, mode)
+        np.copyto(blender.base, base)
+        np.copyto(blender.overlay, overlay)
+        results.append(blender.blend(weights=mask.weights, regions=regions).astype(int))
+    return results
+
+
+def test_regions_match_per_pixel():
+    temps = np.full((24, 32), 20.0)
+    temps[5:9, 20:25] = 50.0
+    per_pixel, regions = _blend_both(temps)
+    assert np.abs(per_pixel - regions).max() <= 1
+
+
+def test_regions_merge_boxes_joined_by_a_merge():
+    # The boxes of the first two regions don't overlap, but their merged box overlaps the third's
+    temps = np.full((24, 32), 20.0)
+    temps[0:11, 2] = 50.0
+    temps[0:2, 10:13] = 50.0
+    temps[12, 2:12] = 50.0
+    regions = HotRegions()
+    regions.update(temps)
+    boxes = [region[:4] for region in regions.regions]
+    for i, (top, bottom, left, right) in enumerate(boxes):
+        for other_top, other_bottom, other_left, other_right in boxes[i + 1:]:
+            assert not (top < other_bottom and other_top < bottom and left < other_right and other_left < right)
+    per_pixel, blended = _blend_both(temps)
+    assert np.abs(per_pixel - blended).max() <= 1
+
+
+def test_regions_with_nothing_hot_leave_base_untouched():
+    per_pixel, regions = _blend_both(np.full((24, 32), 20.0))
+    assert np.array_equal(per_pixel, regions)
+
+
+def test_threshold_blends_inside_rois_like_a_full_frame_mask():
+    temps = np.full((24, 32), 20.0)
+    temps[0:11, 2] = 50.0
+    temps[12, 2:12] = 50.0
+    temps[20:24, 28:32] = 50.0
+    rng = np.random.default_rng(1)
+    base = rng.integers(0, 256, (480, 640, 3), dtype=np.uint8)
+    overlay = rng.integers(0, 256, (480, 640, 3), dtype=np.uint8)
+    mask = ThresholdMask((640, 480))
+    mask.update(temps)
+    blender = FusionBlender((640, 480), 'threshold')
+    np.copyto(blender.base, base)
+    np.copyto(blender.overlay, overlay)
+    blended = blender.blend(mask=mask)
+    expected = np.where(mask.mask[..., None] > 0, cv2.addWeighted(base, 0.5, overlay, 0.5, 0), base)
+    assert np.array_equal(blended, expected)
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/python3
+##################################
+# Blending thermal frames over the HD camera image
+##################################
+import numpy as np
+import cv2
+from therm_render import interpolation_matrix
+
+
+def _hot_boxes(grid, size:tuple):
+    """
+    Boxes (top, bottom, left, right) in output pixels at size (width, height) around the connected
+    non-zero cells of a 24x32 weight grid. Each box is grown by one cell to cover the bilinear spread,
+    and boxes are merged until none overlap, so each output pixel is in at most one.
+    """
+    count, _, stats, _ = cv2.connectedComponentsWithStats((grid > 0).view(np.uint8), connectivity=8)
+    overlapping = lambda box: [b for b in boxes if b[0] < box[1] and box[0] < b[1] and b[2] < box[3] and box[2] < b[3]]
+    boxes = []  # Never overlapping each other
+    for x, y, w, h, _ in stats[1:count].tolist():
+        box = [max(y - 1, 0), min(y + h + 1, 24), max(x - 1, 0), min(x + w + 1, 32)]
+        others = overlapping(box)
+        while others:  # A merged box can reach boxes the original didn't
+            for other in others:
+                boxes.remove(other)
+                box = [min(box[0], other[0]), max(box[1], other[1]), min(box[2], other[2]), max(box[3], other[3])]
+            others = overlapping(box)
+        boxes.append(box)
+    width, height = size
+    return [(y0 * height // 24, -(-y1 * height // 24), x0 * width // 32, -(-x1 * width // 32))
+            for y0, y1, x0, x1 in boxes]
+
+
+class ThresholdMask:
+    """
+    Blend weights for the pixels at or above threshold_c, computed from the 24x32 temperatures in C.
+
+    The weight ramps from 0 to 1 over feather_c degrees around the threshold on the sensor grid, and
+    bilinear upsampling to size (width, height) then softens the edges spatially, so no blur pass is
+    needed. flip mirrors the mask to match pithermalcam images, which are flipped horizontally. The mask
+    is rebuilt only when update() is given a new frame sequence number. rois holds the boxes around the
+    hot regions, (top, bottom, left, right) in output pixels; the mask is zero everywhere else.
+    """
+
+    def __init__(self, size:tuple = (640, 480), threshold_c:float = 40.0, feather_c:float = 1.0, flip:bool = True):
+        self.size = tuple(size)
+        self.threshold_c = threshold_c
+        self.feather_c = feather_c
+        self.flip = flip
+        self.sequence = None
+        self.weights = np.zeros((size[1], size[0]), dtype=np.float32)
+        self._hot = np.zeros((size[1], size[0]), dtype=bool)
+        self.mask = self._hot.view(np.uint8)  # 1 where the weight is non-zero, for cv2 masked operations
+        self.rois = []
+
+    def update(self, temps, sequence:int = None):
+        """Rebuild the mask from a temperature frame unless sequence matches the last one"""
+        if sequence is not None and sequence == self.sequence:
+            return
+        grid = np.asarray(temps, dtype=np.float32).reshape(24, 32)
+        grid = np.clip((np.nan_to_num(grid, nan=-273.15) - self.threshold_c) / self.feather_c + 0.5, 0, 1)
+        if self.flip:
+            grid = np.ascontiguousarray(grid[:, ::-1])
+        cv2.resize(grid, self.size, dst=self.weights, interpolation=cv2.INTER_LINEAR)
+        np.greater(self.weights, 0, out=self._hot)
+        self.rois = _hot_boxes(grid, self.size)
+        self.sequence = sequence
+
+
+class HotRegions:
+    """
+    The ThresholdMask weights, but only inside the bounding boxes of connected hot regions.
+
+    update() labels the connected pixels above threshold_c - feather_c / 2 on the 24x32 grid, grows
+    each box by one sensor cell to cover the bilinear spread, merges overlapping boxes and computes
+    the upsampled weights inside each box alone. blend() then touches only those boxes, so the cost
+    follows the hot area of the scene and a scene with nothing hot costs almost nothing.
+    """
+
+    def __init__(self, size:tuple = (640, 480), threshold_c:float = 40.0, feather_c:float = 1.0, flip:bool = True):
+        self.size = tuple(size)
+        self.threshold_c = threshold_c
+        self.feather_c = feather_c
+        self.flip = flip
+        self.sequence = None
+        self.regions = []  # (top, bottom, left, right, weights) in output pixels, weights 0-1 float32
+        self._rows = interpolation_matrix(24, size[1], 'linear')
+        self._cols_t = np.ascontiguousarray(interpolation_matrix(32, size[0], 'linear').T)
+        self._alpha = None
+        self._scaled = []  # (weights * alpha, 1 - weights * alpha) per region for _alpha
+
+    def update(self, temps, sequence:int = None):
+        """Find the hot regions of a temperature frame unless sequence matches the last one"""
+        if sequence is not None and sequence == self.sequence:
+            return
+        grid = np.asarray(temps, dtype=np.float32).reshape(24, 32)
+        grid = np.clip((np.nan_to_num(grid, nan=-273.15) - self.threshold_c) / self.feather_c + 0.5, 0, 1)
+        if self.flip:
+            grid = np.ascontiguousarray(grid[:, ::-1])
+        width, height = self.size
+        self.regions = []
+        for top, bottom, left, right in _hot_boxes(grid, self.size):
+            y0, y1, x0, x1 = top * 24 // height, -(-bottom * 24 // height), left * 32 // width, -(-right * 32 // width)
+            weights = self._rows[top:bottom, y0:y1] @ grid[y0:y1, x0:x1] @ self._cols_t[x0:x1, left:right]
+            self.regions.append((top, bottom, left, right, weights))
+        self._alpha = None
+        self.sequence = sequence
+
+    def blend(self, base, overlay, alpha:float = 0.5):
+        """Blend overlay into base in place with weight alpha * mask inside the hot regions. Returns base."""
+        if alpha != self._alpha:
+            self._scaled = [(weights * alpha, 1 - weights * alpha) for *_, weights in self.regions]
+            self._alpha = alpha
+        for (top, bottom, left, right, _), (weights, inverse) in zip(self.regions, self._scaled):
+            roi = base[top:bottom, left:right]
+            cv2.blendLinear(overlay[top:bottom, left:right], roi, weights, inverse, dst=roi)
+        return base
+
+
+BLEND_MODES = ['full', 'threshold', 'per_pixel', 'regions', 'premultiplied']
+
+
+class FusionBlender:
+    """
+    Blends an overlay onto a base image of a fixed size using only preallocated buffers.
+
+    Modes:
+        full      - the whole overlay at alpha
+        threshold - the overlay at alpha where mask (a ThresholdMask) is non-zero, blended into base in
+                    place inside mask.rois only and returning base
+        per_pixel - the overlay at alpha * weights (float32 0-1, e.g. ThresholdMask.weights)
+        regions   - the overlay at alpha * weights inside HotRegions only, blended into base in place
+                    and returning base, so cold pixels aren't touched at all
+        premultiplied - a premultiplied BGRA overlay (pithermalcam.get_current_bgra_frame) composited
+                    with its own alpha in one integer multiply-add; alpha is not used
+
+    Fill base and overlay in place, e.g. cv2.resize(frame, size, dst=blender.base) or
+    np.copyto(blender.overlay, frame), then call blend(). The result is written to out, which is
+    reused, so copy or encode it before the next blend. After construction no call allocates arrays.
+    """
+
+    def __init__(self, size:tuple = (640, 480), mode:str = 'full', alpha:float = 0.5):
+        if mode not in BLEND_MODES:
+            raise ValueError(f"Unknown blend mode {mode}, expected one of {BLEND_MODES}")
+        self.size = tuple(size)
+        self.mode = mode
+        self.alpha = alpha
+        shape = (size[1], size[0])
+        self.base = np.zeros(shape + (3,), dtype=np.uint8)
+        self.overlay = np.zeros(shape + (3,), dtype=np.uint8)
+        self.out = np.zeros(shape + (3,), dtype=np.uint8)
+        self._weights = np.zeros(shape, dtype=np.float32)
+        self._inverse_weights = np.zeros(shape, dtype=np.float32)
+        self._inverse_alpha = np.zeros(shape, dtype=np.uint8)
+        self._inverse_alpha3 = np.zeros(shape + (3,), dtype=np.uint8)
+
+    def blend(self, mask:ThresholdMask = None, weights=None, regions:HotRegions = None, bgra=None):
+        """Blend overlay onto base into out and return out. Modes take mask, weights, regions or bgra as named."""
+        if self.mode == 'regions':
+            return regions.blend(self.base, self.overlay, self.alpha)
+        if self.mode == 'threshold':
+            for top, bottom, left, right in mask.rois:  # out is scratch space here
+                roi, scratch = self.base[top:bottom, left:right], self.out[top:bottom, left:right]
+                cv2.addWeighted(roi, 1 - self.alpha, self.overlay[top:bottom, left:right], self.alpha, 0, dst=scratch)
+                cv2.copyTo(scratch, mask.mask[top:bottom, left:right], roi)
+            return self.base
+        if self.mode == 'premultiplied':
+            cv2.extractChannel(bgra, 3, dst=self._inverse_alpha)
+            cv2.bitwise_not(self._inverse_alpha, dst=self._inverse_alpha)
+            cv2.merge((self._inverse_alpha, self._inverse_alpha, self._inverse_alpha), dst=self._inverse_alpha3)
+            cv2.multiply(self.base, self._inverse_alpha3, dst=self.out, scale=1 / 255)
+            cv2.cvtColor(bgra, cv2.COLOR_BGRA2BGR, dst=self.overlay)
+            cv2.add(self.out, self.overlay, dst=self.out)
+            return self.out
+        if self.mode == 'full':
+            cv2.addWeighted(self.base, 1 - self.alpha, self.overlay, self.alpha, 0, dst=self.out)
+        else:
+            np.multiply(weights, self.alpha, out=self._weights)
+            np.subtract(1, self._weights, out=self._inverse_weights)
+            cv2.blendLinear(self.overlay, self.base, self._weights, self._inverse_weights, dst=self.out)
+        return self.out
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/python3
+##################################
+# Filters that run on the 24x32 float temperature grid instead of the rendered image
+##################################
+import warnings
+import numpy as np
+import cv2
+
+GRID_FILTER_MODES = ['median', 'smooth', 'clahe']
+
+
+class GridPrefilter:
+    """
+    Denoise or enhance a temperature frame at sensor resolution, before it is upscaled and coloured.
+
+    Modes:
+        median - per-pixel median of the last history frames, removes single-frame spikes
+        smooth - bilateral filter that only averages neighbours within about smooth_c degrees, keeping edges
+        clahe  - contrast limited adaptive histogram equalization between t_min and t_max
+
+    Filtering 768 pixels replaces a bilateral filter over the 480000 pixels of the rendered image.
+    The output is for display only; statistics should still use the unfiltered temperatures.
+    """
+
+    def __init__(self, mode:str = 'smooth', shape:tuple = (24, 32), history:int = 3, smooth_c:float = 2.0,
+                 clip_limit:float = 2.0):
+        if mode not in GRID_FILTER_MODES:
+            raise ValueError(f"Unknown grid filter mode {mode}, expected one of {GRID_FILTER_MODES}")
+        self.mode = mode
+        self.shape = tuple(shape)
+        self.smooth_c = smooth_c  # Temperature difference in C over which the bilateral filter stops smoothing
+        self._history = np.zeros((history,) + self.shape, dtype=np.float32)
+        self._frames = 0
+        self._clahe = cv2.createCLAHE(clipLimit=clip_limit, tileGridSize=(self.shape[0] // 8, self.shape[1] // 8))
+        self._out = np.empty(self.shape, dtype=np.float32)
+
+    def __call__(self, temps, t_min:float = None, t_max:float = None, out=None):
+        """Return the filtered frame as float32 in out, or a buffer reused by the next call"""
+        if out is None:
+            out = self._out
+        temps = np.asarray(temps, dtype=np.float32).reshape(self.shape)
+        if self.mode == 'median':
+            self._history[self._frames % len(self._history)] = temps
+            self._frames += 1
+            np.median(self._history[:min(self._frames, len(self._history))], axis=0, out=out)
+        elif self.mode == 'smooth':
+            out[...] = cv2.bilateralFilter(np.nan_to_num(temps), 5, self.smooth_c, 1.5)
+        else:
+            scale = 65535 / (t_max - t_min)
+            levels = np.clip((np.nan_to_num(temps) - t_min) * scale, 0, 65535).astype(np.uint16)
+            np.multiply(self._clahe.apply(levels), 1 / scale, out=out)
+            out += t_min
+        return out
+
+
+TEMPORAL_FILTER_MODES = ['ema', 'box', 'adaptive']
+
+
+class TemporalFilter:
+    """
+    Reduce sensor noise by combining consecutive temperature frames, in place on the frame buffer.
+
+    Modes:
+        ema      - exponential moving average, new = old + alpha * (frame - old)
+        box      - mean of the last frames frames
+        adaptive - ema, but pixels that change by more than noise_c restart from the new value so
+                   moving objects don't smear
+
+    Pixels that are not finite yet (the unread half of a first subpage) restart from the new value, and
+    box mode averages only the frames in which a pixel was read.
+    """
+
+    def __init__(self, mode:str = 'adaptive', shape:tuple = (24, 32), alpha:float = 0.3, frames:int = 4,
+                 noise_c:float = 1.5):
+        if mode not in TEMPORAL_FILTER_MODES:
+            raise ValueError(f"Unknown temporal filter mode {mode}, expected one of {TEMPORAL_FILTER_MODES}")
+        self.mode = mode
+        self.alpha = alpha
+        self.noise_c = noise_c  # Change in C treated as real motion rather than noise in adaptive mode
+        self._state = np.full(shape, np.nan, dtype=np.float32)
+        self._history = np.zeros((frames,) + tuple(shape), dtype=np.float32)
+        self._frames = 0
+        self._change = np.empty(shape, dtype=np.float32)
+        self._reset = np.empty(shape, dtype=bool)
+
+    def __call__(self, frame):
+        """Filter frame in place and return it"""
+        view = frame.reshape(self._state.shape)
+        if self.mode == 'box':
+            self._history[self._frames % len(self._history)] = view
+            self._frames += 1
+            with warnings.catch_warnings():  # Pixels not read in any frame yet stay NaN
+                warnings.simplefilter('ignore', RuntimeWarning)
+                np.nanmean(self._history[:min(self._frames, len(self._history))], axis=0, out=view)
+            return frame
+
+        change, reset = self._change, self._reset
+        np.subtract(view, self._state, out=change)
+        if self.mode == 'adaptive':
+            np.greater(np.abs(change), self.noise_c, out=reset)
+        else:
+            reset[...] = False
+        reset |= ~np.isfinite(change)
+        change *= self.alpha
+        self._state += change
+        np.copyto(self._state, view, where=reset)
+        view[...] = self._state
+        return frame
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/python3
+##################################
+# Rendering helpers for turning MLX90640 temperature frames into images
+##################################
+import functools
+import numpy as np
+import cv2
+from scipy import ndimage
+
+
+def _cubic(x, a:float = -0.75):
+    """Keys cubic convolution kernel with the same a as cv2.INTER_CUBIC"""
+    x = np.abs(x)
+    return np.where(x <= 1, ((a + 2) * x - (a + 3)) * x * x + 1,
+                    np.where(x < 2, ((a * x - 5 * a) * x + 8 * a) * x - 4 * a, 0.0))
+
+
+def _linear(x):
+    return np.maximum(1 - np.abs(x), 0.0)
+
+
+def _lanczos(x, lobes:int = 4):
+    """Lanczos windowed sinc, 4 lobes like cv2.INTER_LANCZOS4"""
+    x = np.asarray(x, dtype=np.float64)
+    return np.where(np.abs(x) < lobes, np.sinc(x) * np.sinc(x / lobes), 0.0)
+
+
+_colormap_luts = {}  # Process-wide cache of colormap LUTs by name
+
+
+def colormap_lut(name:str):
+    """
+    Return the 256x1x3 uint8 BGR LUT for a matplotlib colormap name, as cv2.applyColorMap expects.
+
+    LUTs are built with cmapy on first use and then shared read-only across the process, so cmapy and
+    matplotlib are only imported when the first LUT is needed.
+    """
+    lut = _colormap_luts.get(name)
+    if lut is None:
+        import cmapy
+        lut = np.ascontiguousarray(cmapy.cmap(name))
+        lut.setflags(write=False)
+        _colormap_luts[name] = lut
+    return lut
+
+
+def colormap_table(name:str, size:int = 1024):
+    """
+    Return a (size, 3) uint8 BGR table sampling a matplotlib colormap at size evenly spaced points.
+
+    Used with FloatColorizer to map float temperatures straight to colour. Cached like colormap_lut,
+    and matplotlib is only imported when the first table is built.
+    """
+    lut = _colormap_luts.get((name, size))
+    if lut is None:
+        import matplotlib
+        try:
+            cmap = matplotlib.colormaps[name].resampled(size)
+        except AttributeError:  # matplotlib < 3.6
+            cmap = matplotlib.cm.get_cmap(name, size)
+        lut = np.ascontiguousarray(cmap(np.linspace(0, 1, size), bytes=True)[:, 2::-1])
+        lut.setflags(write=False)
+        _colormap_luts[(name, size)] = lut
+    return lut
+
+
+class FloatColorizer:
+    """
+    Map a float temperature image to BGR through a colormap_table in one gather, with no uint8 step.
+
+    Quantizing to 256 levels before colouring causes visible banding; indexing a 1024 or 4096 entry
+    table from the float values keeps gradients smooth without a smoothing filter afterwards.
+    Buffers are reused across calls, so the returned image is overwritten by the next call unless out
+    is given.
+    """
+
+    def __init__(self, shape:tuple = (600, 800)):
+        self.shape = tuple(shape)
+        self._scaled = np.empty(shape, dtype=np.float32)
+        self._index = np.empty(shape, dtype=np.intp)
+        self._image = np.empty(self.shape + (3,), dtype=np.uint8)
+
+    def __call__(self, temps, t_min:float, t_max:float, lut, out=None):
+        """Colour temps, with t_min and t_max at the two ends of lut"""
+        if out is None:
+            out = self._image
+        top = len(lut) - 1
+        scaled = self._scaled
+        np.subtract(temps, t_min, out=scaled)
+        np.multiply(scaled, top / (t_max - t_min), out=scaled)
+        np.nan_to_num(scaled, copy=False)
+        np.clip(scaled, 0, top, out=scaled)
+        np.copyto(self._index, scaled, casting='unsafe')
+        np.take(lut, self._index, axis=0, out=out)
+        return out
+
+
+_KERNELS = {'linear': (_linear, 1), 'cubic': (_cubic, 2), 'lanczos': (_lanczos, 4)}
+
+
+@functools.lru_cache(maxsize=None)
+def interpolation_matrix(n_in:int, n_out:int, kernel:str = 'spline'):
+    """
+    Return the (n_out, n_in) float32 matrix that resamples a length n_in signal to n_out samples.
+
+    'spline' reproduces ndimage.zoom(order=3) exactly, prefilter included, by zooming each unit vector.
+    'linear', 'cubic' and 'lanczos' use pixel-centre alignment like cv2.resize, clamping at the edges.
+    Matrices are cached, so every resampler of the same size shares them.
+    """
+    if kernel == 'spline':
+        return np.stack([ndimage.zoom(np.eye(n_in)[i], n_out / n_in, order=3) for i in range(n_in)], axis=1).astype(np.float32)
+
+    function, support = _KERNELS[kernel]
+    centres = (np.arange(n_out) + 0.5) * n_in / n_out - 0.5  # Output pixel centres in input coordinates
+    taps = np.floor(centres)[:, None] + np.arange(-support + 1, support + 1)
+    weights = function(centres[:, None] - taps)
+    weights /= weights.sum(axis=1, keepdims=True)
+    matrix = np.zeros((n_out, n_in))
+    np.add.at(matrix, (np.repeat(np.arange(n_out), taps.shape[1]), np.clip(taps, 0, n_in - 1).astype(int).ravel()), weights.ravel())
+    return matrix.astype(np.float32)
+
+
+class SeparableResampler:
+    """
+    Upscale 2D float frames with two precomputed matrix multiplies: rows @ frame @ cols.
+
+    Any separable linear interpolation (B-spline, bicubic, Lanczos) is a fixed matrix per axis for a
+    given input and output size, so a 24x32 to 600x800 upscale costs two small matrix products instead
+    of a spline filter and per-pixel coordinate mapping.
+
+    The matrices are dense, so a single NaN input pixel would make the whole output NaN. Pixels that
+    aren't finite (out of range, or the unread half of a first subpage) take their last finite value
+    instead, or the frame minimum if they never had one.
+    """
+
+    def __init__(self, in_shape:tuple = (24, 32), out_shape:tuple = (600, 800), kernel:str = 'spline'):
+        self.in_shape = tuple(in_shape)
+        self.out_shape = tuple(out_shape)
+        self.kernel = kernel
+        self._rows = interpolation_matrix(in_shape[0], out_shape[0], kernel)
+        self._cols_t = np.ascontiguousarray(interpolation_matrix(in_shape[1], out_shape[1], kernel).T)
+        self._tmp = np.empty((out_shape[0], in_shape[1]), dtype=np.float32)
+        self._last = np.full(self.in_shape, np.nan, dtype=np.float32)  # Last finite value of every input pixel
+
+    def __call__(self, frame, out=None):
+        """Return frame resampled to out_shape as float32, written into out if given"""
+        if out is None:
+            out = np.empty(self.out_shape, dtype=np.float32)
+        frame = np.asarray(frame, dtype=np.float32).reshape(self.in_shape)
+        np.copyto(self._last, frame, where=np.isfinite(frame))
+        if np.isnan(self._last).any():  # Never finite yet
+            finite = self._last[~np.isnan(self._last)]
+            np.nan_to_num(self._last, copy=False, nan=finite.min() if finite.size else 0.0)
+        np.matmul(self._rows, self._last, out=self._tmp)
+        np.matmul(self._tmp, self._cols_t, out=out)
+        return out
+
+
+def premultiplied_bgra(image, temps, transparent_c:float = 30.0, opaque_c:float = 40.0, flip:bool = True):
+    """
+    Return a BGRA copy of a BGR thermal image, premultiplied by a per-pixel alpha from the temperatures.
+
+    Alpha ramps from 0 at transparent_c to 255 at opaque_c. It is computed on the 24x32 grid (flipped
+    to match pithermalcam images) and upsampled bilinearly to the image size, so no full-size
+    temperature math is needed. Composite with out = base * (255 - alpha) / 255 + bgr.
+    """
+    height, width = image.shape[:2]
+    grid = np.nan_to_num(np.asarray(temps, dtype=np.float32).reshape(24, 32), nan=transparent_c)
+    grid = np.clip((grid - transparent_c) * (255 / (opaque_c - transparent_c)), 0, 255)
+    if flip:
+        grid = grid[:, ::-1]
+    alpha = cv2.resize(np.ascontiguousarray(grid), (width, height), interpolation=cv2.INTER_LINEAR)
+    alpha = np.rint(alpha).astype(np.uint8)
+    bgra = np.empty((height, width, 4), dtype=np.uint8)
+    bgra[..., :3] = cv2.multiply(image, cv2.merge((alpha, alpha, alpha)), scale=1 / 255)
+    bgra[..., 3] = alpha
+    return bgra
+
+
+class Sprite:
+    """A pre-rendered BGRA image, kept premultiplied so compositing is one multiply and one add"""
+
+    def __init__(self, bgra, ascent:int = 0):
+        self.bgra = bgra
+        self.ascent = ascent  # Rows above the text baseline, for text sprites
+        alpha = cv2.merge([bgra[..., 3]] * 3)
+        self._premultiplied = cv2.multiply(np.ascontiguousarray(bgra[..., :3]), alpha, scale=1 / 255)
+        self._inverse_alpha = 255 - alpha
+
+
+@functools.lru_cache(maxsize=64)
+def text_sprite(text:str, scale:float, thickness:int = 1, color:tuple = (255, 255, 255)):
+    """Render text once into a Sprite, with cv2.putText's antialiasing kept as alpha. Cached by arguments."""
+    (width, height), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, thickness)
+    ascent = height + thickness
+    alpha = np.zeros((ascent + baseline + thickness, width + 2 * thickness), dtype=np.uint8)
+    cv2.putText(alpha, text, (thickness, ascent), cv2.FONT_HERSHEY_SIMPLEX, scale, 255, thickness)
+    bgra = np.empty(alpha.shape + (4,), dtype=np.uint8)
+    bgra[..., :3] = color
+    bgra[..., 3] = alpha
+    return Sprite(bgra, ascent)
+
+
+def draw_sprite(image, sprite:Sprite, x:int, y:int):
+    """Alpha-composite sprite onto a BGR image in place with its top left corner at (x, y), clipped to the image"""
+    top, left = max(y, 0), max(x, 0)
+    bottom, right = min(y + sprite.bgra.shape[0], image.shape[0]), min(x + sprite.bgra.shape[1], image.shape[1])
+    if bottom <= top or right <= left:
+        return
+    rows, cols = slice(top - y, bottom - y), slice(left - x, right - x)
+    roi = image[top:bottom, left:right]
+    cv2.add(cv2.multiply(roi, sprite._inverse_alpha[rows, cols], scale=1 / 255), sprite._premultiplied[rows, cols], dst=roi)
+
+
+def draw_text(image, text:str, origin:tuple, scale:float, thickness:int = 1, color:tuple = (255, 255, 255)):
+    """Cached-sprite replacement for cv2.putText with FONT_HERSHEY_SIMPLEX; origin is the bottom left of the text"""
+    sprite = text_sprite(text, scale, thickness, color)
+    draw_sprite(image, sprite, origin[0] - thickness, origin[1] - sprite.ascent)
+
+
+class HudOverlay:
+    """
+    Status line drawn as a fast-changing numeric field followed by a cached settings sprite.
+
+    Only the numbers (temperature range, FPS) are rasterized each frame, into a field sized for the
+    widest expected value so the settings sprite stays at a fixed position. The settings text is
+    rendered once per distinct value, so it is only redrawn when a setting changes.
+    """
+
+    def __init__(self, origin:tuple = (30, 18), scale:float = .4, thickness:int = 1,
+                 numbers_template:str = 'Tmin=+000.0F - Tmax=+000.0F - FPS=00.0 - '):
+        self.origin = origin
+        self.scale = scale
+        self.thickness = thickness
+        self._numbers_width = cv2.getTextSize(numbers_template, cv2.FONT_HERSHEY_SIMPLEX, scale, thickness)[0][0]
+
+    def draw(self, image, numbers:str, settings:str):
+        """Draw the numbers with putText and the settings from its cached sprite"""
+        x, y = self.origin
+        cv2.putText(image, numbers, (x, y), cv2.FONT_HERSHEY_SIMPLEX, self.scale, (255, 255, 255), self.thickness)
+        draw_text(image, settings, (x + self._numbers_width, y), self.scale, self.thickness)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/python3
+##################################
+# Per-frame temperature statistics, computed once and shared by every consumer of the frame
+##################################
+import numpy as np
+
+
+class FrameStats:
+    """
+    Min, max, mean, hottest/coldest pixel, percentiles and histogram of one temperature frame.
+
+    Everything is derived from a single argsort of the frame's 768 pixels. NaN pixels (the unread
+    half of a first subpage) are left out. sequence and timestamp identify the frame the statistics
+    belong to, so a cached instance can be checked against the newest frame before reuse.
+    """
+
+    def __init__(self, temps, sequence:int = 0, timestamp:float = None, percentiles:tuple = (5, 25, 50, 75, 95),
+                 hist_range:tuple = (-20, 120), bins:int = 28):
+        temps = np.asarray(temps)
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.shape = temps.shape if temps.ndim == 2 else (24, 32)
+        flat = temps.reshape(-1)
+        order = np.argsort(flat)
+        ordered = flat[order]
+        count = int(np.searchsorted(ordered, np.nan))  # NaN sorts last
+        self.count = count  # Number of valid pixels
+        ordered = ordered[:count]
+
+        if count:
+            self.min = float(ordered[0])
+            self.max = float(ordered[-1])
+            self.mean = float(np.mean(ordered))
+            self.min_pos = divmod(int(order[0]), self.shape[1])  # (row, column) of the coldest pixel
+            self.max_pos = divmod(int(order[count - 1]), self.shape[1])  # (row, column) of the hottest pixel
+            ranks = np.asarray(percentiles, dtype=np.float64) / 100 * (count - 1)
+            self.percentiles = dict(zip(percentiles, np.interp(ranks, np.arange(count), ordered).tolist()))
+        else:
+            self.min = self.max = self.mean = float('nan')
+            self.min_pos = self.max_pos = None
+            self.percentiles = {q: float('nan') for q in percentiles}
+        self.hist_edges = np.linspace(hist_range[0], hist_range[1], bins + 1)
+        self.hist_counts = np.diff(np.searchsorted(ordered, self.hist_edges))  # Pixels outside hist_range aren't counted
+
+    def as_dict(self):
+        """Plain-Python copy suitable for json.dumps"""
+        return {'sequence': self.sequence, 'timestamp': self.timestamp, 'count': self.count,
+                'min': self.min, 'max': self.max, 'mean': self.mean, 'min_pos': self.min_pos, 'max_pos': self.max_pos,
+                'percentiles': self.percentiles, 'hist_edges': self.hist_edges.tolist(), 'hist_counts': self.hist_counts.tolist()}
@@ -1,4 +1,4 @@
-from flask import Flask, Response, render_template
+from flask import Flask, render_template, request
 import threading
 import time
 import io
@@ -8,14 +8,16 @@ try:  # If called as an imported module
     from pithermalcam import pithermalcam
 except:  # If run directly
     from pi_therm_cam import pithermalcam
+from frame_ring import FrameSlot, newest_frames
+from stream_hub import VariantHubs
+from stream_server import run
 
 app = Flask(__name__)
 
 # Global variables for HD and Thermal camera frames
-hd_output_frame = None
-thermal_output_frame = None
-hd_lock = threading.Lock()
-thermal_lock = threading.Lock()
+frames_ready = threading.Condition()  # hd_frames and thermal_frames notify the one Condition the overlay renderer waits on
+hd_frames = FrameSlot(frames_ready)
+thermal_frames = FrameSlot(frames_ready)
 
 # Define the desired crop dimensions for HD camera
 CROP_TOP = 198
@@ -25,7 +27,6 @@ CROP_RIGHT = 294
 
 # HD Camera Thread and Functionality
 def capture_hd_frames():
-    global hd_output_frame, hd_lock
     picam2_hd = Picamera2()
     config_hd = picam2_hd.create_preview_configuration(main={"size": (1270, 950)})  # Set capture size to 1270x950
     picam2_hd.configure(config_hd)
@@ -40,56 +41,52 @@ def capture_hd_frames():
         # Convert to RGB for compatibility with OpenCV
         cropped_hd_image = cv2.cvtColor(cropped_hd_image, cv2.COLOR_BGR2RGB)
         
-        with hd_lock:
-            hd_output_frame = cropped_hd_image.copy()
+        hd_frames.publish(cropped_hd_image)
 
 # Thermal Camera Thread and Functionality
 def pull_images():
-    global thermal_output_frame, thermal_lock
     thermcam = pithermalcam(output_folder='/home/pi/pithermalcam/saved_snapshots/')
     time.sleep(0.1)
 
     while True:
         current_frame = thermcam.update_image_frame()
         if current_frame is not None:
-            with thermal_lock:
-                thermal_output_frame = current_frame.copy()
+            thermal_frames.publish(current_frame)
 
 # Flask Routes
 @app.route("/")
 def index():
     return render_template("index.html")
 
-def generate():
-    global hd_output_frame, thermal_output_frame, hd_lock, thermal_lock
-    alpha = 0.5  # Transparency factor
+alpha = 0.5  # Transparency factor
 
-    while True:
-        with hd_lock:
-            hd_frame = hd_output_frame.copy() if hd_output_frame is not None else None
-        with thermal_lock:
-            thermal_frame = thermal_output_frame.copy() if thermal_output_frame is not None else None
-        
-        if hd_frame is None or thermal_frame is None:
-            continue
+def frame_renderer(size:tuple = (640, 480), layout:str = 'blend'):
+    """Return a render_frame for one stream variant, blending at size (width, height)"""
+    seen = (0, 0)  # Sequence numbers of the HD and thermal frames last rendered
 
-        # Resize thermal frame to match the HD frame size
-        hd_frame = cv2.resize(hd_frame, (640, 480))
-        thermal_frame = cv2.resize(thermal_frame, (640, 480))
+    def render_frame():
+        """Blend the newest frames, or return None if neither camera has a new frame within a second"""
+        nonlocal seen
+        seen, frames = newest_frames((hd_frames, thermal_frames), seen, timeout=1.0)
+        if frames is None:
+            return None
+        hd_frame, thermal_frame = frames
+
+        # Resize both frames to the output size
+        hd_frame = cv2.resize(hd_frame, size)
+        thermal_frame = cv2.resize(thermal_frame, size)
 
         # Blend the thermal frame with the HD frame
-        blended_frame = cv2.addWeighted(hd_frame, 1 - alpha, thermal_frame, alpha, 0)
+        return cv2.addWeighted(hd_frame, 1 - alpha, thermal_frame, alpha, 0)
+    return render_frame
 
-        # Encode combined frame
-        (flag, encoded_image) = cv2.imencode(".jpg", blended_frame)
-        if not flag:
-            continue
-        
-        yield (b'--frame\r\n' b'Content-Type: image/jpeg\r\n\r\n' + bytearray(encoded_image) + b'\r\n')
+# Variants for ?w=&h=&q=
+stream_variants = VariantHubs(frame_renderer, (640, 480), layouts=('blend',))
 
 @app.route("/video_feed")
 def video_feed():
-    return Response(generate(), mimetype="multipart/x-mixed-replace; boundary=frame")
+    # ?w=&h=&q= select an overlay variant
+    return stream_variants.response(request.args)
 
 if __name__ == '__main__':
     # Start HD camera thread
@@ -102,5 +99,5 @@ if __name__ == '__main__':
     thermal_thread.daemon = True
     thermal_thread.start()
 
-    # Run Flask app
-    app.run(host='0.0.0.0', port=8010, debug=True, threaded=True, use_reloader=False)
+    # Run Flask app; --async suits many idle viewers of the overlay
+    run(app, {'/video_feed': stream_variants}, port=8010)